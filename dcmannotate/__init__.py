@@ -3,7 +3,8 @@
 __version__ = "0.0.7"
 from .annotations import Annotations, AnnotationSet
 from .measurements import Ellipse, Measurement, PointMeasurement
-from .dicomvolume import DicomVolume  # usort: skip
+from .dicomvolume import DicomVolume, VolumeError  # usort: skip
+from .header_index import HeaderIndex
 from .utils import Point
 
 __all__ = [
@@ -14,5 +15,7 @@ __all__ = [
     "PointMeasurement",
     "Ellipse",
     "DicomVolume",
+    "VolumeError",
+    "HeaderIndex",
     "VisageWriter",
 ]
@@ -11,6 +11,7 @@ from dcmannotate import readers, serialization
 from dcmannotate.annotations import AnnotationsParsed
 from dcmannotate.serialization import AnnotationEncoder
 from . import DicomVolume
+from .header_index import HeaderIndex
 from .utils import annotation_format
 
 log = logging.getLogger(f"{__package__}.{__name__}")
@@ -63,7 +64,7 @@ def write(args: Any) -> List[Path]:
         exit(1)
 
     in_files = maybe_glob(args.volume_files)
-    volume = DicomVolume(in_files)
+    volume = DicomVolume(in_files, workers=args.workers, index=args.index)
 
     if not args.annotations:
         annotations = "\n".join(sys.stdin.readlines())
@@ -74,13 +75,33 @@ def write(args: Any) -> List[Path]:
 
     try:
         if args.format == "sc":
-            result_files = volume.write_sc(args.destination, force=args.force)
+            result_files = volume.write_sc(
+                args.destination,
+                force=args.force,
+                grayscale=args.grayscale,
+                only_annotated=args.only_annotated,
+                compression=args.compression,
+                incremental=args.incremental,
+            )
         elif args.format == "sr":
-            result_files = volume.write_sr(args.destination, force=args.force)
+            result_files = volume.write_sr(
+                args.destination,
+                force=args.force,
+                engine=args.sr_engine,
+                combined=args.combined,
+            )
+        elif args.format == "overlay":
+            result_files = volume.write_overlay(args.destination, force=args.force)
         elif args.format == "visage":
             result_files = [volume.write_visage(args.destination, force=args.force)]
         elif args.format == "png":
-            result_files = volume.write_png(args.destination, force=args.force)
+            result_files = volume.write_png(
+                args.destination,
+                force=args.force,
+                grayscale=args.grayscale,
+                only_annotated=args.only_annotated,
+                compress_level=args.compress_level,
+            )
         else:
             log.error(f"Unsupported format {args.format}")
             exit(1)
@@ -108,8 +129,8 @@ def read(args: Any) -> str:
 
     if format == "sr":
         for d in datasets:
-            measurements, sop_id = readers.sr.get_measurements(d)
-            annotations.append(AnnotationsParsed(measurements, sop_id))
+            for sop_id, measurements in readers.sr.get_measurements_by_image(d).items():
+                annotations.append(AnnotationsParsed(measurements, sop_id))
 
     elif format == "sc":
         for d in datasets:
@@ -122,7 +143,9 @@ def read(args: Any) -> str:
                 "Input appears to be a Visage PR. For these files, you must pass the original volume with -v"
             )
             exit(1)
-        in_volume = DicomVolume(maybe_glob(args.volume_files))
+        in_volume = DicomVolume(
+            maybe_glob(args.volume_files), workers=args.workers, index=args.index
+        )
         annotations = readers.visage.read_annotations(in_volume, in_files[0])
     k = AnnotationEncoder()
     result = k.encode(annotations)
@@ -130,6 +153,45 @@ def read(args: Any) -> str:
     return result
 
 
+def index(args: Any) -> HeaderIndex:
+    if not args.volume_files:
+        log.fatal("No input volume files provided.")
+        exit(1)
+
+    in_files = maybe_glob(args.volume_files)
+    if args.destination:
+        header_index = HeaderIndex(args.destination)
+    else:
+        header_index = HeaderIndex.next_to(in_files)
+    DicomVolume(in_files, read_pixels=False, workers=args.workers, index=header_index)
+    log.info(f"Indexed {len(in_files)} files in {header_index.path}.")
+    return header_index
+
+
+def add_index_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--index",
+        nargs="?",
+        const=True,
+        default=None,
+        dest="index",
+        help="Use a header index (see 'dcmannotate index') to open the volume faster. "
+        "Takes the path of the index; defaults to the one next to the volume files.",
+    )
+
+
+def add_workers_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "-j",
+        "--workers",
+        dest="workers",
+        type=int,
+        default=None,
+        help="Number of parallel workers used to read the input volume, render sc and png "
+        "output and write sr output.",
+    )
+
+
 def make_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         "dcmannotate",
@@ -137,6 +199,7 @@ def make_parser() -> argparse.ArgumentParser:
         epilog="""Examples:
         dcmannotate read -i ./slice_sr.*.dcm
         dcmannotate read -i visage_pr.dcm -v slice.[0-9].dcm
+        dcmannotate index -i ./slice.*.dcm
         """,
         formatter_class=argparse.RawTextHelpFormatter,
     )
@@ -148,8 +211,9 @@ def make_parser() -> argparse.ArgumentParser:
     write_parser = subparsers.add_parser("write", help="Write dicom annotations.")
     write_parser.add_argument(
         "format",
-        choices=["sr", "sc", "visage", "png"],
-        help="Output format: Structured Report, Secondary Capture, or Visage",
+        choices=["sr", "sc", "visage", "png", "overlay"],
+        help="Output format: Structured Report, Secondary Capture, Visage, PNG, or an overlay "
+        "plane on a copy of the annotated slices",
     )
     write_parser.add_argument(
         "-i",
@@ -178,6 +242,55 @@ def make_parser() -> argparse.ArgumentParser:
         action="store_true",
         help="Overwrite destination if files exist.",
     )
+    write_parser.add_argument(
+        "--grayscale",
+        dest="grayscale",
+        action="store_true",
+        help="sc and png only: write slices without annotations as 8-bit grayscale, not RGB.",
+    )
+    write_parser.add_argument(
+        "--only-annotated",
+        dest="only_annotated",
+        action="store_true",
+        help="sc and png only: write only the slices that have annotations.",
+    )
+    write_parser.add_argument(
+        "--compress-level",
+        dest="compress_level",
+        type=int,
+        choices=range(10),
+        default=6,
+        metavar="0-9",
+        help="png only: zlib compression level. Defaults to 6.",
+    )
+    write_parser.add_argument(
+        "--compression",
+        dest="compression",
+        choices=["rle", "deflate"],
+        default=None,
+        help="sc only: compress with RLE Lossless or Deflated Explicit VR Little Endian.",
+    )
+    write_parser.add_argument(
+        "--sr-engine",
+        dest="sr_engine",
+        choices=["native", "xml2dsr"],
+        default="native",
+        help="sr only: build the reports in-process (default), or convert them with DCMTK.",
+    )
+    write_parser.add_argument(
+        "--combined",
+        dest="combined",
+        action="store_true",
+        help="sr only: write one report for all annotated slices, to a single file.",
+    )
+    write_parser.add_argument(
+        "--incremental",
+        dest="incremental",
+        action="store_true",
+        help="sc only: update earlier output, rendering only the slices that changed.",
+    )
+    add_workers_argument(write_parser)
+    add_index_argument(write_parser)
     write_parser.set_defaults(func=write)
 
     read_parser = subparsers.add_parser("read", help="Read dicom annotations.")
@@ -197,8 +310,30 @@ def make_parser() -> argparse.ArgumentParser:
         type=Path,
         help="For Visage only: files corresponding to the referenced dicom volume. Accepts a list or a glob pattern.",
     )
+    add_workers_argument(read_parser)
+    add_index_argument(read_parser)
 
     read_parser.set_defaults(func=read)
+
+    index_parser = subparsers.add_parser(
+        "index", help="Build or refresh the header index of a dicom volume."
+    )
+    index_parser.add_argument(
+        "-i",
+        "--volume-files",
+        nargs="+",
+        dest="volume_files",
+        type=Path,
+        help="Input volume paths. Accepts a list or a glob pattern.",
+    )
+    index_parser.add_argument(
+        "-o",
+        dest="destination",
+        help=f"Path of the index. Defaults to {HeaderIndex.DEFAULT_NAME} next to the volume "
+        "files.",
+    )
+    add_workers_argument(index_parser)
+    index_parser.set_defaults(func=index)
     return parser
 
 
@@ -169,14 +169,11 @@ class AnnotationSetParsed:
     def with_reference(self, volume: "DicomVolume") -> "AnnotationSet":
         annotations: List[Annotations] = []
         for a in self.__list:
-            for s in volume:
-                if s.SOPInstanceUID == a.SOPInstanceUID:
-                    # measurements.reference = s
-                    annotations.append(a.with_reference(s))
-                    break
-            else:
+            s = volume.get(a.SOPInstanceUID)
+            if s is None:
                 raise Exception(
                     "ReferencedSOPInstanceUID for this SC does not exist in volume."
                 )
+            annotations.append(a.with_reference(s))
 
         return AnnotationSet(annotations)
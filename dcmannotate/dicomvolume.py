@@ -1,31 +1,249 @@
-import tempfile
+import inspect
+import logging
+import os
+import struct
 import types
+import warnings
+from collections import Counter
 from pathlib import Path
 
-from typing import Any, cast, Dict, Iterator, List, Optional, Sequence, TYPE_CHECKING, Union
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    TYPE_CHECKING,
+    TypeVar,
+    Union,
+    cast,
+)
 
 import numpy as np  # type: ignore
 import pydicom
 
-from PIL import Image  # type: ignore
 from pydicom import dcmread
 from pydicom.dataset import Dataset
+from pydicom.errors import InvalidDicomError
+from pydicom.pixel_data_handlers.util import pixel_dtype
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
 
 from dcmannotate import serialization
 
 from . import readers, writers
 from .annotations import Annotations, AnnotationSet
-from .utils import annotation_format
+from .header_index import HeaderIndex
+from .utils import annotation_format, LRUCache, parallel_map
 
 if TYPE_CHECKING:
     # https://mypy.readthedocs.io/en/latest/runtime_troubles.html#using-classes-that-are-generic-in-stubs-but-not-at-runtime
-    import os
-
     PathLike = os.PathLike[str]
 else:
     from os import PathLike
 
 
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# The tags pydicom needs to decode PixelData.
+PIXEL_TAGS = [
+    "SamplesPerPixel",
+    "PhotometricInterpretation",
+    "PlanarConfiguration",
+    "NumberOfFrames",
+    "Rows",
+    "Columns",
+    "BitsAllocated",
+    "BitsStored",
+    "HighBit",
+    "PixelRepresentation",
+    "PixelData",
+]
+
+
+# The tags needed to group files into volumes and to verify and sort them.
+VOLUME_TAGS = [
+    "SOPInstanceUID",
+    "SeriesInstanceUID",
+    "FrameOfReferenceUID",
+    "ImageOrientationPatient",
+    "ImagePositionPatient",
+    "Rows",
+    "Columns",
+    "SpacingBetweenSlices",
+]
+
+
+# The tags kept on each slice in slim mode: those needed by DicomVolume and by the writers.
+SLIM_TAGS = [
+    *VOLUME_TAGS,
+    *(tag for tag in PIXEL_TAGS if tag != "PixelData"),
+    "SpecificCharacterSet",
+    "SOPClassUID",
+    "InstanceNumber",
+    "PatientName",
+    "PatientID",
+    "PatientBirthDate",
+    "PatientSex",
+    "PatientPosition",
+    "StudyInstanceUID",
+    "StudyID",
+    "StudyDate",
+    "StudyTime",
+    "StudyDescription",
+    "AccessionNumber",
+    "ReferringPhysicianName",
+    "PatientOrientation",
+    "PixelSpacing",
+    "RescaleSlope",
+    "RescaleIntercept",
+    "RescaleType",
+    "ImageHorizontalFlip",
+    "ImageRotation",
+]
+
+
+# The tags of an existing SC output that incremental write_sc compares against: the
+# SourceImageSequence, the SeriesInstanceUID, and the creator and content hash of the
+# dcmannotate private block.
+SC_HEADER_TAGS = [(0x0008, 0x2112), (0x0020, 0x000E), (0x0091, 0x0010), (0x0091, 0x1002)]
+
+# The display window of the SC output, on the rescaled pixel values.
+SC_WINDOW = [0, 1]
+
+
+def _duplicates(values: Iterable[T]) -> List[T]:
+    """Returns each value that occurs more than once, in order of first appearance."""
+    return [value for value, count in Counter(values).items() if count > 1]
+
+
+class VolumeError(ValueError):
+    """Raised when a set of slices does not make up a single, evenly spaced volume."""
+
+
+def _output_files(
+    slices: Sequence[Dataset], pattern: Union[str, "PathLike"], force: Optional[bool]
+) -> List[Path]:
+    """The file for each slice, from its z_index. Raises FileExistsError if any of them
+    exists and force is not set, so that nothing is written."""
+    pattern = str(pattern)
+    if "*" not in pattern:
+        raise Exception("Pattern must include a '*' wildcard.")
+    files = [Path(pattern.replace("*", f"{ds.z_index:03}")) for ds in slices]
+    if not force:
+        for f in files:
+            if f.exists():
+                raise FileExistsError(
+                    f"{f} already exists and force=False, aborting with no files written."
+                )
+    return files
+
+
+def _save_all(
+    items: Iterable[T], files: List[Path], save: Callable[[T, Path], Any]
+) -> List[Path]:
+    """Save each item to a temporary file next to its file as soon as it is produced, and
+    move them all into place once every item is saved. If any of them fails, the temporary
+    files are removed again and the existing files are left as they were, so that either
+    all of them are written or none."""
+    temporary = [filename.with_name(filename.name + ".tmp") for filename in files]
+    try:
+        for item, tmp in zip(items, temporary):
+            save(item, tmp)
+    except BaseException:
+        for tmp in temporary:
+            try:
+                tmp.unlink()
+            except FileNotFoundError:
+                pass
+        raise
+    for tmp, filename in zip(temporary, files):
+        os.replace(tmp, filename)
+    return files
+
+
+def _read_sc_header(path: Path) -> Optional[Dataset]:
+    """Read the series and the dcmannotate private block of an SC written by write_sc.
+    Returns None if it is not a DICOM file or has no such block."""
+    try:
+        ds = dcmread(path, stop_before_pixels=True, specific_tags=SC_HEADER_TAGS)
+    except InvalidDicomError:
+        return None
+    if (0x0091, 0x0010) not in ds or ds[0x0091, 0x0010].value != "dcmannotate":
+        return None
+    return ds
+
+
+def _read_header(path: Path) -> Optional[Dataset]:
+    """Read just the tags in VOLUME_TAGS from a file, as a stub to be loaded in full later.
+    Returns None if it is not a DICOM file or is missing any of them."""
+    try:
+        ds = dcmread(path, stop_before_pixels=True, specific_tags=VOLUME_TAGS)
+    except InvalidDicomError:
+        return None
+    if any(tag not in ds for tag in VOLUME_TAGS):
+        return None
+    ds.from_path = path
+    ds.is_stub = True
+    return ds
+
+
+def _pixel_data_offset(fp: BinaryIO, ds: Dataset) -> Optional[int]:
+    """Find where the PixelData value starts in the file, if it can be memory-mapped as is.
+
+    Only single-frame, single-sample, uncompressed little endian pixel data qualifies.
+    Expects fp to be positioned at the PixelData element, where dcmread leaves it when
+    called with stop_before_pixels=True.
+
+    Returns:
+        Optional[int]: The offset in bytes, or None.
+    """
+    transfer_syntax = ds.file_meta.get("TransferSyntaxUID")
+    if transfer_syntax not in (ExplicitVRLittleEndian, ImplicitVRLittleEndian):
+        return None
+    if (
+        ds.get("SamplesPerPixel") != 1
+        or int(ds.get("NumberOfFrames") or 1) != 1
+        or ds.get("BitsAllocated") not in (8, 16, 32)
+        or "PixelRepresentation" not in ds
+    ):
+        return None
+
+    start = fp.tell()
+    explicit = transfer_syntax == ExplicitVRLittleEndian
+    header = fp.read(12 if explicit else 8)
+    if len(header) < 8 or struct.unpack("<HH", header[:4]) != (0x7FE0, 0x0010):
+        return None
+    if explicit:
+        if len(header) < 12 or header[4:6] not in (b"OB", b"OW"):
+            return None
+        (length,) = struct.unpack("<L", header[8:12])
+    else:
+        (length,) = struct.unpack("<L", header[4:8])
+    if length == 0xFFFFFFFF or length < ds.Rows * ds.Columns * ds.BitsAllocated // 8:
+        return None  # encapsulated or truncated
+    return start + len(header)
+
+
+def _read_dataset(
+    path: "PathLike", read_pixels: bool, memmap: bool = False, slim: bool = False
+) -> Dataset:
+    specific_tags = None
+    if slim:
+        specific_tags = SLIM_TAGS + (["PixelData"] if read_pixels else [])
+    with open(path, "rb") as fp:
+        ds = dcmread(fp, stop_before_pixels=(not read_pixels), specific_tags=specific_tags)
+        if memmap and not read_pixels:
+            ds.pixel_data_offset = _pixel_data_offset(fp, ds)
+    ds.from_path = Path(path)
+    return ds
+
+
 class DicomVolume:
 
     ImageOrientationPatient: str
@@ -34,6 +252,7 @@ class DicomVolume:
     Rows: int
     Columns: int
     SpacingBetweenSlices: Any
+    spacing_tolerance: float
 
     annotation_set: Optional["AnnotationSet"]
     files: List[Path]
@@ -43,10 +262,137 @@ class DicomVolume:
         datasets: Union[Sequence[Dataset], Sequence[PathLike]],
         annotations: Optional["AnnotationSet"] = None,
         read_pixels: bool = True,
+        *,
+        workers: Optional[int] = None,
+        processes: bool = False,
+        lazy: bool = False,
+        cache_bytes: int = 256 * 2**20,
+        memmap: bool = False,
+        spacing_tolerance: float = 1e-3,
+        index: Union[None, bool, str, PathLike, HeaderIndex] = None,
+        slim: bool = False,
     ) -> None:
-        self.__load(datasets, read_pixels)
+        """
+        Args:
+            datasets (Union[Sequence[Dataset], Sequence[PathLike]]):
+                The slices, loaded or as paths.
+            annotations (AnnotationSet, optional):
+                Annotations for this volume. Defaults to None.
+            read_pixels (bool, optional): Read pixel data. Defaults to True.
+            workers (int, optional):
+                Number of workers used to read files in parallel. Defaults to None, reading
+                serially.
+            processes (bool, optional):
+                Read with a pool of processes instead of threads. Defaults to False.
+            lazy (bool, optional):
+                Keep only header data; pixels are read from disk when needed. Defaults to
+                False.
+            cache_bytes (int, optional):
+                Memory budget for pixel arrays read on demand. Defaults to 256 MiB.
+            memmap (bool, optional):
+                Like lazy, but uncompressed pixel data is memory-mapped from the file rather
+                than decoded into memory. Defaults to False.
+            spacing_tolerance (float, optional):
+                How far, in mm, the spacing between adjacent slices may vary. Defaults to 1e-3.
+            index (Union[bool, str, PathLike, HeaderIndex], optional):
+                A HeaderIndex, or the path of one, caching the parsed headers of the files.
+                Files found in it are not parsed again until they are accessed, and files not
+                found are added to it. Pass True to use the default index next to the files.
+                Defaults to None, for no index; False is the same.
+            slim (bool, optional):
+                Read only the tags in SLIM_TAGS from each file, leaving out private groups,
+                vendor sequences, overlays and so on. The rest can still be read with
+                full_dataset(). Datasets passed in directly are kept as they are.
+                Defaults to False.
+        """
+        self.spacing_tolerance = spacing_tolerance
+        self.__pixel_cache = LRUCache(cache_bytes)
+        self.__array: Optional[Any] = None
+        self.__read_pixels = read_pixels and not (lazy or memmap)
+        self.__memmap = memmap
+        self.__workers = workers
+        self.__processes = processes
+        self.__slim = slim
+        self.__header_index = index
+        self.__load(datasets)
         self.annotation_set = annotations
 
+    @staticmethod
+    def scan(
+        directory: Union[str, PathLike],
+        *,
+        recursive: bool = True,
+        workers: Optional[int] = None,
+        processes: bool = False,
+    ) -> List[List[Dataset]]:
+        """Find the DICOM files in a directory and group them into candidate volumes by
+        SeriesInstanceUID and ImageOrientationPatient. Only the tags in VOLUME_TAGS are read;
+        files that are not DICOM or lack those tags are ignored.
+
+        Args:
+            directory (Union[str, PathLike]): The directory to scan.
+            recursive (bool, optional): Also scan subdirectories. Defaults to True.
+            workers (int, optional): Number of parallel readers. Defaults to None.
+            processes (bool, optional): Read in worker processes. Defaults to False.
+
+        Returns:
+            List[List[Dataset]]: Header stubs for each group, to be passed to DicomVolume.
+        """
+        directory = Path(directory)
+        candidates = directory.rglob("*") if recursive else directory.glob("*")
+        paths = sorted(p for p in candidates if p.is_file())
+        groups: Dict[Any, List[Dataset]] = {}
+        for ds in parallel_map(_read_header, paths, workers=workers, processes=processes):
+            if ds is None:
+                continue
+            orientation = tuple(round(float(v), 4) for v in ds.ImageOrientationPatient)
+            groups.setdefault((ds.SeriesInstanceUID, orientation), []).append(ds)
+        return list(groups.values())
+
+    @classmethod
+    def from_directory(
+        cls,
+        directory: Union[str, PathLike],
+        *,
+        recursive: bool = True,
+        **kwargs: Any,
+    ) -> List["DicomVolume"]:
+        """Build a lazily-loaded DicomVolume for every series in a directory; see scan().
+        Full headers are read when the slices of a volume are first accessed. Groups of files
+        that do not make up a valid volume, such as single images, are skipped and logged;
+        any other error is raised.
+
+        Args:
+            directory (Union[str, PathLike]): The directory to scan.
+            recursive (bool, optional): Also scan subdirectories. Defaults to True.
+            kwargs: Passed on to DicomVolume(); lazy defaults to True.
+
+        Returns:
+            List[DicomVolume]: The volumes found.
+        """
+        # Checked up front, since errors building each volume are only caught for invalid ones.
+        unknown = sorted(set(kwargs) - (set(inspect.signature(cls).parameters) - {"datasets"}))
+        if unknown:
+            raise TypeError(
+                f"from_directory() got unexpected keyword arguments: {', '.join(unknown)}"
+            )
+        kwargs.setdefault("lazy", True)
+        stub_groups = cls.scan(
+            directory,
+            recursive=recursive,
+            workers=kwargs.get("workers"),
+            processes=kwargs.get("processes", False),
+        )
+        volumes = []
+        for stubs in stub_groups:
+            try:
+                volumes.append(cls(stubs, **kwargs))
+            except VolumeError as e:
+                log.info(
+                    f"Skipping {len(stubs)} file(s) from {stubs[0].from_path.parent}: {e}"
+                )
+        return volumes
+
     def annotate_with(
         self,
         annotation_set: "Union[AnnotationSet,List[Annotations]]",
@@ -120,95 +466,410 @@ class DicomVolume:
         """
         self.annotate_with(serialization.read_annotations_from_json(self, json), force)
 
-    def __load(
-        self,
-        param: Union[Sequence[Dataset], Sequence[PathLike]],
-        read_pixels: bool = True,
-    ) -> None:
+    def __load(self, param: Union[Sequence[Dataset], Sequence[PathLike]]) -> None:
         """Loads datasets from file paths if necessary.
 
         Args:
             param (Union[Sequence[Dataset], Sequence[PathLike]]): A list of datasets or paths.
-            read_pixels (bool, optional):
-                Read pixel data; usually want to do this but could be skipped in special cases.
-                Defaults to True.
         """
         datasets: List[Dataset] = []
+        header_index: Any = None
+        misses: List[PathLike] = []
         if isinstance(param, list) and isinstance(param[0], Dataset):
             datasets = param
         else:
-            for path in param:
-                if param.count(path) > 1:
-                    raise ValueError("A volume cannot reference the same file more than once.")
-                # assert isinstance(path, PathLike)
-                ds = dcmread(path, stop_before_pixels=(not read_pixels))
-                ds.from_path = Path(path)
-                datasets.append(ds)
+            duplicate_paths = _duplicates(Path(path) for path in param)
+            if duplicate_paths:
+                raise ValueError(
+                    "A volume cannot reference the same file more than once. Duplicates: "
+                    + ", ".join(str(p) for p in duplicate_paths)
+                )
+            header_index = self.__header_index
+            if header_index is False:
+                header_index = None
+            elif header_index is True:
+                header_index = HeaderIndex.next_to(param)
+            elif header_index is not None and not isinstance(header_index, HeaderIndex):
+                header_index = HeaderIndex(header_index)
+
+            cached: List[Optional[Dataset]] = [None] * len(param)
+            if header_index is not None:
+                cached = [header_index.lookup(path) for path in param]
+            misses = [path for path, ds in zip(param, cached) if ds is None]
+            # Results come back in input order, so the order seen by sort_by_z is
+            # deterministic.
+            loaded = iter(list(self.__read(misses)))
+            datasets = [ds if ds is not None else next(loaded) for ds in cached]
         if len(datasets) < 2:
-            raise ValueError("A volume must include at least two slices.")
+            raise VolumeError("A volume must include at least two slices.")
         self.__verify(datasets)
+        # Cached headers still need sorting: the order depends on the other files in the
+        # volume.
         self.__datasets = self.sort_by_z(datasets)
+        if isinstance(header_index, HeaderIndex) and misses:
+            header_index.update(self.__datasets, VOLUME_TAGS)
+            try:
+                header_index.save()
+            except OSError as e:
+                # The index is only a cache; the volume opens without it.
+                warnings.warn(f"Could not save the header index {header_index.path}: {e}")
+        self.__index: Dict[str, int] = {
+            ds.SOPInstanceUID: k for k, ds in enumerate(self.__datasets)
+        }
+        self.__has_stubs = any(getattr(ds, "is_stub", False) for ds in self.__datasets)
+
+    def __read(self, paths: Sequence[PathLike]) -> Iterator[Dataset]:
+        """Read files in parallel according to the options this volume was created with."""
+        return parallel_map(
+            _read_dataset,
+            paths,
+            [self.__read_pixels] * len(paths),
+            [self.__memmap] * len(paths),
+            [self.__slim] * len(paths),
+            workers=self.__workers,
+            processes=self.__processes,
+        )
 
-    def make_sc(self) -> "DicomVolume":
-        """Generate Dicom Secondary Capture datasets from attached annotations, returns a DicomVolume.
+    def __slices(self) -> List[Dataset]:
+        """The slices of this volume, after replacing any header stubs with the full
+        datasets."""
+        if self.__has_stubs:
+            stubs = [ds for ds in self.__datasets if getattr(ds, "is_stub", False)]
+            for stub, ds in zip(stubs, self.__read([stub.from_path for stub in stubs])):
+                if ds.SOPInstanceUID != stub.SOPInstanceUID:
+                    raise ValueError(f"{stub.from_path} has changed since it was scanned.")
+                ds.z_index = stub.z_index
+                ds.z_spacing = stub.z_spacing
+                self.__datasets[stub.z_index] = ds
+            self.__has_stubs = False
+        return self.__datasets
+
+    def pixel_array(self, slice: Union[int, Dataset]) -> Any:
+        """Get the pixel data of a slice. Once array() has been called, this is a view into
+        it. Otherwise, if the slice was loaded without its pixels, they are memory-mapped from
+        its file where possible, or else read from it and kept in a bounded
+        least-recently-used cache.
+
+        Args:
+            slice (Union[int, Dataset]): The slice, or its index in this volume.
 
         Returns:
-            DicomVolume: A DicomVolume with the resulting SC images as slices.
+            numpy.ndarray: The decoded pixel data.
+        """
+        ds = self[slice] if isinstance(slice, int) else slice
+        if self.__array is not None and ds.SOPInstanceUID in self.__index:
+            return self.__array[self.__index[ds.SOPInstanceUID]]
+        return self.__pixels_of(ds, cache=True)
+
+    def full_dataset(self, slice: Union[int, Dataset]) -> Dataset:
+        """Read the complete dataset of a slice from its file, for when the slices of this
+        volume were loaded slim or without pixel data.
+
+        Args:
+            slice (Union[int, Dataset]): The slice, or its index in this volume.
+
+        Returns:
+            Dataset: A new dataset with every tag of the file, including its pixel data.
         """
+        ds = self[slice] if isinstance(slice, int) else slice
+        if not hasattr(ds, "from_path"):
+            return ds
+        full = dcmread(ds.from_path)
+        full.from_path = ds.from_path
+        full.z_index = ds.z_index
+        full.z_spacing = ds.z_spacing
+        return full
+
+    def array(self) -> Any:
+        """Get the pixel data of the whole volume as one read-only (Z, Rows, Columns) array,
+        in z-order. It is built once, in a single preallocated buffer, and kept; pixel_array()
+        returns views into it from then on.
+
+        Returns:
+            numpy.ndarray: The stacked pixel data.
+        """
+        if self.__array is None:
+            slices = self.__slices()
+            first = self.__pixels_of(slices[0], cache=False)
+            dtype = np.result_type(*(pixel_dtype(ds) for ds in slices))
+            stack = np.empty((len(slices),) + first.shape, dtype=dtype)
+            stack[0] = first
+            for k in range(1, len(slices)):
+                stack[k] = self.__pixels_of(slices[k], cache=False)
+            stack.flags.writeable = False
+            self.__array = stack
+            self.__pixel_cache.clear()
+        return self.__array
+
+    def __pixels_of(self, ds: Dataset, cache: bool) -> Any:
+        """Decode, map or look up the pixels of a slice; see pixel_array()."""
+        if "PixelData" in ds:
+            return ds.pixel_array
+        if not hasattr(ds, "from_path"):
+            raise ValueError(
+                f"Slice {ds.SOPInstanceUID} has no pixel data and was not loaded from a file."
+            )
+        offset = getattr(ds, "pixel_data_offset", None)
+        if offset is not None:
+            return np.memmap(
+                ds.from_path,
+                dtype=pixel_dtype(ds),
+                mode="r",
+                offset=offset,
+                shape=(ds.Rows, ds.Columns),
+            )
+        arr = self.__pixel_cache.get(ds.SOPInstanceUID)
+        if arr is None:
+            arr = dcmread(ds.from_path, specific_tags=PIXEL_TAGS).pixel_array
+            if cache:
+                self.__pixel_cache.put(ds.SOPInstanceUID, arr)
+        return arr
+
+    def __generate_sc(
+        self,
+        grayscale: bool,
+        only_annotated: bool,
+        workers: Optional[int],
+        compression: Optional[str] = None,
+        slices: Optional[List[Dataset]] = None,
+        series_instance_uid: Optional[str] = None,
+    ) -> Iterator[Dataset]:
         if self.annotation_set is None:
             raise Exception("There are no annotations for this volume.")
         pydicom.config.INVALID_KEYWORD_BEHAVIOR = "IGNORE"
         try:
-            sc_result = writers.sc.generate(self, self.annotation_set, [0, 1])
-            return DicomVolume(sc_result)
+            yield from writers.sc.generate(
+                self,
+                self.annotation_set,
+                SC_WINDOW,
+                grayscale=grayscale,
+                only_annotated=only_annotated,
+                workers=self.__workers if workers is None else workers,
+                compression=compression,
+                slices=slices,
+                series_instance_uid=series_instance_uid,
+            )
         finally:
             pydicom.config.INVALID_KEYWORD_BEHAVIOR = "WARN"
 
+    def __is_rendered_from(self, sc: Dataset) -> bool:
+        """Whether an SC image was rendered from a slice of this volume, by its
+        SourceImageSequence."""
+        source = sc.get("SourceImageSequence")
+        if not source or "ReferencedSOPInstanceUID" not in source[0]:
+            return False
+        return self.get(source[0].ReferencedSOPInstanceUID) is not None
+
+    def __rendered_files(
+        self, pattern: Union[str, Path], force: Optional[bool], only_annotated: bool
+    ) -> List[Path]:
+        """The output files of the slices to render, checked before anything is rendered."""
+        if self.annotation_set is None:
+            raise Exception("There are no annotations for this volume.")
+        slices = writers.sc.slices_to_render(self, self.annotation_set, only_annotated)
+        return _output_files(slices, pattern, force)
+
+    def make_sc(
+        self,
+        *,
+        grayscale: bool = False,
+        workers: Optional[int] = None,
+        compression: Optional[str] = None,
+    ) -> "DicomVolume":
+        """Generate Dicom Secondary Capture datasets from attached annotations, returns a DicomVolume.
+
+        Args:
+            grayscale (bool, optional): Emit slices without annotations as 8-bit MONOCHROME2
+                images instead of RGB. Defaults to False.
+            workers (int, optional): Render the slices in a pool of this many processes.
+                Defaults to the workers of this volume.
+            compression (str, optional): "rle" for RLE Lossless or "deflate" for Deflated
+                Explicit VR Little Endian. Defaults to None, for uncompressed images.
+
+        Returns:
+            DicomVolume: A DicomVolume with the resulting SC images as slices.
+        """
+        return DicomVolume(list(self.__generate_sc(grayscale, False, workers, compression)))
+
     def write_sc(
-        self, pattern: Union[str, Path], *, force: Optional[bool] = False
+        self,
+        pattern: Union[str, Path],
+        *,
+        force: Optional[bool] = False,
+        grayscale: bool = False,
+        only_annotated: bool = False,
+        workers: Optional[int] = None,
+        compression: Optional[str] = None,
+        incremental: bool = False,
     ) -> List[Path]:
         """Write out attached annotations as Dicom Secondary Capture files.  Pass force=True to overwrite existing files.
 
         Args:
             pattern (string): Pattern for output file names, eg "./out/slice_sr.*.dcm".
+            grayscale (bool, optional): Write slices without annotations as 8-bit MONOCHROME2
+                images instead of RGB. Defaults to False.
+            only_annotated (bool, optional): Only render and write the slices that have
+                annotations, named by their z-index in this volume. Defaults to False.
+            workers (int, optional): Render the slices in a pool of this many processes.
+                Defaults to the workers of this volume.
+            compression (str, optional): "rle" for RLE Lossless or "deflate" for Deflated
+                Explicit VR Little Endian. Defaults to None, for uncompressed images.
+            incremental (bool, optional): Update the output of an earlier write_sc. Existing
+                files that were rendered from the same slice, annotations and options are
+                kept as they are; the rest are rendered again into the same series. Existing
+                files that were not rendered from a slice of this volume still require
+                force=True, and are not added to their series. Defaults to False.
 
         Returns:
-            List[Path]: A list of the created files.
+            List[Path]: A list of the created files. With incremental=True, only the files
+            that were rendered again.
         """
+        if not incremental:
+            files = self.__rendered_files(pattern, force, only_annotated)
+            scs = self.__generate_sc(grayscale, only_annotated, workers, compression)
+            return _save_all(scs, files, writers.sc.save)
 
-        return self.make_sc().save_as(pattern, force=force)
+        if self.annotation_set is None:
+            raise Exception("There are no annotations for this volume.")
+        slices = writers.sc.slices_to_render(self, self.annotation_set, only_annotated)
+        files = _output_files(slices, pattern, True)
+        outdated = []
+        series_instance_uid = None
+        k = serialization.AnnotationEncoder()
+        for slice, filename in zip(slices, files):
+            if not filename.exists():
+                outdated.append((slice, filename))
+                continue
+            existing = _read_sc_header(filename)
+            if existing is None or not self.__is_rendered_from(existing):
+                if not force:
+                    raise FileExistsError(
+                        f"{filename} already exists and was not written by write_sc for this "
+                        "volume, aborting with no files written."
+                    )
+                outdated.append((slice, filename))
+                continue
+            series_instance_uid = series_instance_uid or existing.get("SeriesInstanceUID")
+            annotations = self.annotation_set.get(slice.SOPInstanceUID)
+            encoded = k.encode(annotations) if annotations else "{}"
+            expected = writers.sc.content_hash(
+                slice, encoded, SC_WINDOW, grayscale, compression
+            )
+            if readers.sc.get_content_hash(existing) != expected:
+                outdated.append((slice, filename))
+
+        scs = self.__generate_sc(
+            grayscale,
+            only_annotated,
+            workers,
+            compression,
+            slices=[slice for slice, _ in outdated],
+            series_instance_uid=series_instance_uid,
+        )
+        return _save_all(scs, [f for _, f in outdated], writers.sc.save)
 
     def write_png(
+        self,
+        pattern: Union[str, Path],
+        *,
+        force: Optional[bool] = False,
+        grayscale: bool = False,
+        only_annotated: bool = False,
+        workers: Optional[int] = None,
+        compress_level: int = 6,
+    ) -> List[Path]:
+        """Write out attached annotations drawn into PNG images, one per slice, identical to
+        the Secondary Capture output. Pass force=True to overwrite existing files.
+        The images are encoded straight from the rendered pixels, without building DICOM
+        datasets for them.
+
+        Args:
+            pattern (string): Pattern for output file names, eg "./out/slice.*.png".
+            grayscale (bool, optional): Write slices without annotations as 8-bit grayscale
+                images instead of RGB. Defaults to False.
+            only_annotated (bool, optional): Only render and write the slices that have
+                annotations, named by their z-index in this volume. Defaults to False.
+            workers (int, optional): Render and encode the slices in a pool of this many
+                processes. Defaults to the workers of this volume.
+            compress_level (int, optional): The zlib compression level of the PNG files,
+                from 0 to 9. Defaults to 6.
+
+        Returns:
+            List[Path]: A list of the created files.
+        """
+        files = self.__rendered_files(pattern, force, only_annotated)
+        pngs = writers.png.generate(
+            self,
+            cast(AnnotationSet, self.annotation_set),
+            SC_WINDOW,
+            grayscale=grayscale,
+            only_annotated=only_annotated,
+            workers=self.__workers if workers is None else workers,
+            compress_level=compress_level,
+        )
+        return _save_all(pngs, files, lambda data, f: f.write_bytes(data))
+
+    def make_overlay(self) -> List[Dataset]:
+        """Generate a copy of each annotated slice with the attached annotations in a 1-bit
+        overlay plane, keeping the original pixel data.
+
+        Returns:
+            List[Dataset]: The annotated copies, in z-order.
+        """
+        if self.annotation_set is None:
+            raise Exception("There are no annotations for this volume.")
+        return list(writers.overlay.generate(self, self.annotation_set))
+
+    def write_overlay(
         self, pattern: Union[str, Path], *, force: Optional[bool] = False
     ) -> List[Path]:
-        volume = self.make_sc()
-        files = []
+        """Write out a copy of each annotated slice with the attached annotations in a 1-bit
+        overlay plane. The original pixel data is copied as it is stored. Pass force=True to
+        overwrite existing files.
 
-        for slice in volume:
-            outfile = Path(str(pattern).replace("*", f"{slice.z_index:03}"))
-            if outfile.exists() and not force:
-                raise FileExistsError(
-                    f"{outfile} already exists and force=False, aborting with no files written."
-                )
-            files.append(outfile)
+        Args:
+            pattern (string): Pattern for output file names, eg "./out/slice_overlay.*.dcm".
 
-        for filename, slice in zip(files, volume):
-            im = Image.fromarray(slice.pixel_array)
-            im.save(filename, "png")
-        return files
+        Returns:
+            List[Path]: A list of the created files.
+        """
+        files = self.__rendered_files(pattern, force, only_annotated=True)
+        datasets = writers.overlay.generate(self, cast(AnnotationSet, self.annotation_set))
+        return _save_all(datasets, files, lambda ds, f: ds.save_as(f))
 
-    def make_sr(self) -> List[Dataset]:
-        """Generate Dicom Structured Report datasets from attached annotations.
+    def make_sr(
+        self, *, engine: str = "native", workers: Optional[int] = None, combined: bool = False
+    ) -> List[Dataset]:
+        """Generate Dicom Structured Report datasets from attached annotations, in memory.
+
+        Args:
+            engine (str, optional): "native" to build the reports in-process, or "xml2dsr"
+                to convert them with DCMTK. Defaults to "native".
+            workers (int, optional): Write this many reports at once. Defaults to the workers
+                of this volume.
+            combined (bool, optional): Generate a single report for all annotated slices,
+                with the native engine. Defaults to False.
 
         Returns:
             List[Dataset]: The generated datasets.
         """
-        with tempfile.TemporaryDirectory() as dir:
-            files = self.write_sr(dir + "/" + "slice.*.dcm")
-            return [dcmread(f) for f in files]
+        if self.annotation_set is None:
+            raise Exception("There are no annotations for this volume.")
+        return writers.sr.make(
+            self.annotation_set,
+            engine=engine,
+            workers=self.__workers if workers is None else workers,
+            combined=combined,
+        )
 
     def write_sr(
-        self, pattern: Optional[str] = None, *, force: Optional[bool] = False
+        self,
+        pattern: Optional[str] = None,
+        *,
+        force: Optional[bool] = False,
+        engine: str = "native",
+        workers: Optional[int] = None,
+        combined: bool = False,
     ) -> List[Path]:
         """Write out Dicom Structured Reports.  Pass force=True to overwrite existing files.
 
@@ -216,6 +877,13 @@ class DicomVolume:
             pattern (string, optional):
                 Pattern for output file names, eg "./out/slice_sr.*.dcm".
                 If None, uses input filenames as basis. Defaults to None.
+            engine (str, optional): "native" to build the reports in-process, or "xml2dsr"
+                to convert them from the XML templates with DCMTK. Defaults to "native".
+            workers (int, optional): Write this many reports at once, in a pool of threads.
+                If any of them fails, none are written. Defaults to the workers of this volume.
+            combined (bool, optional): Write a single report for all annotated slices, with
+                the native engine. The pattern is then the path of that file. Defaults to
+                False.
 
         Raises:
             Exception: This volume must be annotated.
@@ -226,7 +894,14 @@ class DicomVolume:
         if self.annotation_set is None:
             raise Exception("There are no annotations for this volume.")
 
-        return writers.sr.generate(self.annotation_set, pattern, force=force)
+        return writers.sr.generate(
+            self.annotation_set,
+            pattern,
+            force=force,
+            engine=engine,
+            workers=self.__workers if workers is None else workers,
+            combined=combined,
+        )
 
     def make_visage(self) -> Dataset:
         """Generate Visage PR dataset from attached annotations.
@@ -271,30 +946,54 @@ class DicomVolume:
             List[Path]: The created files.
         """
 
-        pattern = str(pattern)
-        if "*" not in pattern:
-            raise Exception("Pattern must include a '*' wildcard.")
-        files = [Path(pattern.replace("*", f"{sc.z_index:03}")) for sc in self.__datasets]
-
-        if not force:
-            for f in files:
-                if f.exists():
-                    raise FileExistsError(
-                        f"{f} already exists and force=False, aborting with no files written."
-                    )
-        for sc, filename in zip(self.__datasets, files):
-            sc.save_as(filename)
+        files = _output_files(self.__slices(), pattern, force)
+        _save_all(self.__slices(), files, lambda ds, f: ds.save_as(f))
         self.files = files
         return files
 
-    def sort_by_z(self, datasets: List[Dataset]) -> List[Dataset]:
+    def sort_by_z(
+        self, datasets: List[Dataset], tolerance: Optional[float] = None
+    ) -> List[Dataset]:
         """
         Sort the given datasets along the orientation axis.
+
+        Args:
+            datasets (List[Dataset]): The slices to sort.
+            tolerance (float, optional):
+                How far, in mm, the spacing between adjacent slices may vary.
+                Defaults to self.spacing_tolerance.
         """
-        orientation = datasets[0].ImageOrientationPatient  # These will all be identical
-        # Doesn't matter which one you use, we are moving relative to it
-        start_position = np.asarray(datasets[0].ImagePositionPatient)
+        if tolerance is None:
+            tolerance = self.spacing_tolerance
+        # These will all be identical
+        normal = self.__set_axes(datasets[0].ImageOrientationPatient)
+
+        positions = np.array([ds.ImagePositionPatient for ds in datasets], dtype=float)
+        # The displacement of each slice along the normal (might be negative), relative to the
+        # first one. Doesn't matter which one you use, we are moving relative to it.
+        zs = (positions - positions[0]) @ normal
 
+        # actually sort by the calculated z values
+        order = np.argsort(zs, kind="stable")
+        sorted_by_z = [datasets[i] for i in order]
+
+        spacings = np.linalg.norm(np.diff(positions[order], axis=0), axis=1)
+        if spacings.max() - spacings.min() > tolerance:
+            raise VolumeError(
+                "Volume slices are not evenly spaced along the z-axis. The slice "
+                "ImagePositionPatient z-values, relative to the first slice, appear to be "
+                f"{zs[order].tolist()}. Could a slice be missing?"
+            )
+        z_spacing = float(np.median(spacings))
+
+        for k in range(len(sorted_by_z)):
+            sorted_by_z[k].z_index = k
+            sorted_by_z[k].z_spacing = z_spacing
+        return sorted_by_z
+
+    def __set_axes(self, orientation: Sequence[float]) -> Any:
+        """Sets self.axis_x, axis_y and axis_z from an ImageOrientationPatient, returning
+        axis_z."""
         normal = np.cross(
             # A vector pointing along the ImageOrientation axis
             orientation[0:3],
@@ -304,42 +1003,7 @@ class DicomVolume:
         self.axis_x = orientation[0:3]
         self.axis_y = orientation[3:6]
         self.axis_z = normal
-
-        zs: Dict[str, float] = {}
-        for ds in datasets:
-            if not zs:  # the z-value of the dicom at the start position will be zero
-                zs[ds.SOPInstanceUID] = 0
-            else:  # the z-value of every other dicom is relative to that
-                pos = np.asarray(ds.ImagePositionPatient)
-                # calculate the displacement along the normal (might be negative)
-                z = np.dot(pos - start_position, normal)
-                zs[ds.SOPInstanceUID] = z
-
-        # actually sort by the calculated z values
-        sorted_by_z = sorted(datasets, key=lambda x: zs[x.SOPInstanceUID])
-
-        def calc_spacing(i: int) -> float:
-            return cast(
-                float,
-                np.abs(
-                    np.linalg.norm(
-                        np.asarray(sorted_by_z[i + 1].ImagePositionPatient)
-                        - np.asarray(sorted_by_z[i].ImagePositionPatient)
-                    )
-                ),
-            )
-
-        spacings = set(calc_spacing(i) for i in range(len(sorted_by_z) - 1))
-        if len(spacings) > 1:
-            raise ValueError(
-                f"Volume slices are not evenly spaced along the z-axis. The slice ImagePositionPatient z-values, relative to the first slice, appear to be {sorted(zs.values())}. Could a slice be missing?"
-            )
-        z_spacing = spacings.pop()
-
-        for k in range(len(sorted_by_z)):
-            sorted_by_z[k].z_index = k
-            sorted_by_z[k].z_spacing = z_spacing
-        return sorted_by_z
+        return normal
 
     def __verify(self, datasets: List[Dataset]) -> None:
         """Verifies that the given datasets appear to make up a single series.
@@ -349,14 +1013,9 @@ class DicomVolume:
             datasets (List[Dataset]): The datasets to verify.
         """
 
-        def attr_uniq(list: List[Any], attr: str) -> bool:
-            """
-            Returns True if all the values of the given attribute are unique.
-            """
-            return len(set([getattr(d, attr) for d in list])) == len(list)
-
         def attr_same(list: List[Any], attr: str) -> bool:
-            return all(getattr(x, attr) == getattr(list[0], attr) for x in list)
+            first = getattr(list[0], attr, None)
+            return first is not None and all(getattr(x, attr, None) == first for x in list)
 
         tags_equal = [
             "ImageOrientationPatient",
@@ -367,25 +1026,52 @@ class DicomVolume:
             "SpacingBetweenSlices",
         ]
         if not all(attr_same(datasets, attr) for attr in tags_equal):
-            raise Exception(
+            raise VolumeError(
                 f"Not a volume: tags [{', '.join(tags_equal)}] must be present and identical"
             )
         for tag in tags_equal:
             setattr(self, tag, getattr(datasets[0], tag))
 
-        if not attr_uniq(datasets, "SOPInstanceUID"):
-            raise ValueError(
-                f"Duplicate SOPInstanceUID detected on volume. Possibly caused by a slice being accidentally included twice."
+        duplicate_uids = _duplicates(d.SOPInstanceUID for d in datasets)
+        if duplicate_uids:
+            raise VolumeError(
+                "Duplicate SOPInstanceUID detected on volume. Possibly caused by a slice "
+                f"being accidentally included twice. Duplicates: {', '.join(duplicate_uids)}"
             )
 
+    def get(
+        self, sop_instance_uid: str, default: Optional[Dataset] = None
+    ) -> Optional[Dataset]:
+        """Look up a slice by its SOPInstanceUID.
+
+        Args:
+            sop_instance_uid (str): The SOPInstanceUID of the slice.
+            default (Dataset, optional): Returned if there is no such slice. Defaults to None.
+
+        Returns:
+            Optional[Dataset]: The slice.
+        """
+        z_index = self.__index.get(str(sop_instance_uid))
+        if z_index is None:
+            return default
+        return self.__slices()[z_index]
+
+    def index_of(self, sop_instance_uid: str) -> int:
+        """Get the z-index of the slice with the given SOPInstanceUID. Raises KeyError if
+        there is none."""
+        return self.__index[str(sop_instance_uid)]
+
+    def __contains__(self, sop_instance_uid: Any) -> bool:
+        return str(sop_instance_uid) in self.__index
+
     def __getitem__(self, key: int) -> Dataset:
-        return self.__datasets[key]
+        return self.__slices()[key]
 
     def __len__(self) -> int:
         return self.__datasets.__len__()
 
     def __iter__(self) -> Iterator[Dataset]:
-        yield from self.__datasets
+        yield from self.__slices()
 
     def __repr__(self) -> str:
         return f"<Volume {self.Rows}x{self.Columns}x{len(self)} -> {self.axis_z}{', annotated' if self.annotation_set else ''}>"
@@ -0,0 +1,112 @@
+import json
+import os
+import tempfile
+import warnings
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional, Sequence, TYPE_CHECKING, Union
+
+from pydicom.dataset import Dataset
+
+if TYPE_CHECKING:
+    PathLike = os.PathLike[str]
+else:
+    from os import PathLike
+
+# Version 1 also cached the z_index of each file, which is only valid in the volume it was
+# computed for; those indexes are ignored.
+INDEX_VERSION = 2
+
+
+class HeaderIndex:
+    """A sidecar file caching the parsed volume headers of DICOM files, so that a volume can
+    be opened again without re-parsing them. Entries are keyed by file path, and are only
+    used while the size and modification time of the file are unchanged."""
+
+    DEFAULT_NAME = ".dcmannotate_index.json"
+
+    path: Path
+    changed: bool
+
+    def __init__(self, path: Union[str, PathLike]):
+        self.path = Path(path)
+        self.changed = False
+        self.__entries: Dict[str, Dict[str, Any]] = {}
+        if self.path.exists():
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+                if data.get("version") == INDEX_VERSION:
+                    self.__entries = dict(data["files"])
+            except (ValueError, OSError, KeyError, AttributeError, TypeError) as e:
+                # The index is only a cache; an unreadable one is rebuilt from the files.
+                warnings.warn(f"Ignoring the unreadable header index {self.path}: {e!r}")
+
+    @classmethod
+    def next_to(cls, files: Sequence[Union[str, PathLike]]) -> "HeaderIndex":
+        """The index in the directory of the first of the given files."""
+        return cls(Path(files[0]).parent / cls.DEFAULT_NAME)
+
+    @staticmethod
+    def __key(path: Union[str, PathLike]) -> str:
+        return str(Path(path).resolve())
+
+    @staticmethod
+    def __stat(path: Union[str, PathLike]) -> Dict[str, int]:
+        st = os.stat(path)
+        return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+    def lookup(self, path: Union[str, PathLike]) -> Optional[Dataset]:
+        """Get the cached header of a file as a stub dataset.
+
+        Returns:
+            Optional[Dataset]: The stub, or None if the file is not indexed or has changed.
+        """
+        entry = self.__entries.get(self.__key(path))
+        if entry is None or entry["stat"] != self.__stat(path):
+            return None
+        ds = Dataset.from_json(entry["header"])
+        ds.from_path = Path(path)
+        ds.is_stub = True
+        return ds
+
+    def update(self, datasets: Iterable[Dataset], tags: Sequence[str]) -> None:
+        """Add or refresh the entries for the given slices.
+
+        Args:
+            datasets (Iterable[Dataset]): Slices with from_path set.
+            tags (Sequence[str]): The keywords of the tags to store.
+        """
+        for ds in datasets:
+            header = Dataset()
+            for tag in tags:
+                header[tag] = ds[tag]
+            self.__entries[self.__key(ds.from_path)] = {
+                "stat": self.__stat(ds.from_path),
+                "header": header.to_json_dict(),
+            }
+        self.changed = True
+
+    def save(self) -> None:
+        """Write the index out, replacing the existing file atomically. The temporary file is
+        unique, so that processes indexing the same directory do not write into each
+        other's."""
+        fd, tmp = tempfile.mkstemp(
+            dir=self.path.parent, prefix=self.path.name + ".", suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"version": INDEX_VERSION, "files": self.__entries}, f)
+            os.replace(tmp, self.path)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+        self.changed = False
+
+    def __contains__(self, path: Union[str, PathLike]) -> bool:
+        return self.lookup(path) is not None
+
+    def __len__(self) -> int:
+        return len(self.__entries)
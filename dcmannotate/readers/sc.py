@@ -21,6 +21,7 @@ pydicom.datadict.add_private_dict_entries(
             "Annotation data version",
         ),
         0x00911001: ("LT", "1", "AnnotationData", "Annotation data"),
+        0x00911002: ("LO", "1", "AnnotationContentHash", "Annotation content hash"),
     },
 )
 
@@ -54,6 +55,33 @@ def get_measurements(dataset: Union[Dataset, str, Path]) -> Optional[Annotations
     return parse_annotations(block[0x01].value)
 
 
+def get_content_hash(dataset: Union[Dataset, str, Path]) -> Optional[str]:
+    """Retrieves the content hash of this SC dataset, which identifies what it was rendered
+    from.
+
+    Args:
+        dataset (Union[Dataset, str, Path]): The dataset or a path to it. Only the header of
+            a file is read.
+
+    Returns:
+        Optional[str]: The hash, or None if the dataset was not written by dcmannotate or
+        predates content hashes.
+    """
+    ds: Dataset
+    if isinstance(dataset, (str, PathLike)):
+        ds = pydicom.dcmread(dataset, stop_before_pixels=True)
+    else:
+        ds = dataset
+
+    try:
+        block = ds.private_block(0x0091, "dcmannotate")
+    except KeyError:
+        return None
+    if 0x02 not in block:
+        return None
+    return str(block[0x02].value)
+
+
 def parse_annotations(json: str) -> Optional[AnnotationsParsed]:
     d = AnnotationDecoder()
     result = d.decode(json)
@@ -82,10 +110,8 @@ def read_annotations(
         measurements = get_measurements(f)
         if measurements is None:
             continue
-        for s in volume:
-            if s.SOPInstanceUID == measurements.SOPInstanceUID:
-                annotations.append(measurements.with_reference(s))
-                break
-        else:
+        s = volume.get(measurements.SOPInstanceUID)
+        if s is None:
             raise Exception("ReferencedSOPInstanceUID for this SC does not exist in volume.")
+        annotations.append(measurements.with_reference(s))
     return AnnotationSet(annotations)
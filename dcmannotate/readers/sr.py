@@ -1,6 +1,6 @@
 from os import PathLike
 from pathlib import Path
-from typing import cast, List, Sequence, Tuple, TYPE_CHECKING, Union
+from typing import cast, Callable, Dict, List, Optional, Sequence, Tuple, TYPE_CHECKING, Union
 
 import pydicom
 from pydicom.dataset import Dataset
@@ -50,14 +50,64 @@ def find_content_items(sr: Dataset, code: Code) -> List[Dataset]:
     return found_items
 
 
-def get_measurements(dataset: Union[Dataset, str, Path]) -> Tuple[List[Measurement], str]:
-    """Retrieves measurements from this SR dataset.
+def read_measurement_group(group: Dataset) -> Optional[Tuple[Measurement, str]]:
+    """Read the measurement of a Measurement Group content item.
+
+    Args:
+        group (Dataset): The measurement group.
+
+    Returns:
+        Optional[Tuple[Measurement, str]]: The measurement and the ReferencedSOPInstanceUID of
+        its image, or None if its GraphicType is not POINT or ELLIPSE.
+    """
+    n = find_value_type(group, "NUM")
+    gtype = n.ContentSequence[0].GraphicType
+    if gtype not in ("POINT", "ELLIPSE"):
+        return None
+    data = n.ContentSequence[0].GraphicData
+    referenced_sop_instance_uid = (
+        find_value_type(n.ContentSequence[0], "IMAGE")
+        .ReferencedSOPSequence[0]
+        .ReferencedSOPInstanceUID
+    )
+    try:
+        code = find_value_type(group, "CODE")
+    except ValueError:
+        code = None
+    if code and code.ConceptCodeSequence[0].CodeValue == "CORNERSTONEFREETEXT":
+        value = code.ConceptCodeSequence[0].CodeMeaning
+        unit = None
+    else:
+        value = float(n.MeasuredValueSequence[0].NumericValue)
+        unit = n.MeasuredValueSequence[0].MeasurementUnitsCodeSequence[0].CodeMeaning
+
+    measurement: Measurement
+    if gtype == "POINT":
+        measurement = PointMeasurement(data[0], data[1], unit, value)
+    else:
+        measurement = Ellipse(
+            Point(data[0], data[5]),
+            (data[6] - data[4]) / 2.0,
+            (data[3] - data[1]) / 2.0,
+            unit,
+            value,
+        )
+    return measurement, str(referenced_sop_instance_uid)
+
+
+def get_measurements_by_image(
+    dataset: Union[Dataset, str, Path]
+) -> Dict[str, List[Measurement]]:
+    """Retrieves measurements from this SR dataset, grouped by the image they reference. A
+    report written with combined=True references every annotated slice of a volume.
+    Measurements of other graphic types than POINT and ELLIPSE are skipped.
 
     Args:
         dataset (Union[Dataset, str, Path]): The dataset or a path to it
 
     Returns:
-        Tuple[List[Measurement], str]: A list of measurements and the ReferencedSOPInstanceUID.
+        Dict[str, List[Measurement]]: The measurements of each ReferencedSOPInstanceUID, in
+        the order of the report.
     """
     assert type(codes.DCM) is _CodesDict
 
@@ -67,42 +117,28 @@ def get_measurements(dataset: Union[Dataset, str, Path]) -> Tuple[List[Measureme
     else:
         ds = dataset
     measurement_groups = find_content_items(ds, cast(Code, codes.DCM.MeasurementGroup))
-    result: List[Measurement] = []
-    referenced_sop_instance_uid = ""
+    result: Dict[str, List[Measurement]] = {}
     for m in measurement_groups:
-        n = find_value_type(m, "NUM")
-        gtype = n.ContentSequence[0].GraphicType
-        data = n.ContentSequence[0].GraphicData
-        if not referenced_sop_instance_uid:
-            referenced_sop_instance_uid = (
-                find_value_type(n.ContentSequence[0], "IMAGE")
-                .ReferencedSOPSequence[0]
-                .ReferencedSOPInstanceUID
-            )
-        try:
-            code = find_value_type(m, "CODE")
-        except ValueError:
-            code = None
-        if code and code.ConceptCodeSequence[0].CodeValue == "CORNERSTONEFREETEXT":
-            value = code.ConceptCodeSequence[0].CodeMeaning
-            unit = None
-        else:
-            value = float(n.MeasuredValueSequence[0].NumericValue)
-            unit = n.MeasuredValueSequence[0].MeasurementUnitsCodeSequence[0].CodeMeaning
-
-        if gtype == "POINT":
-            result.append(PointMeasurement(data[0], data[1], unit, value))
-        if gtype == "ELLIPSE":
-            result.append(
-                Ellipse(
-                    Point(data[0], data[5]),
-                    (data[6] - data[4]) / 2.0,
-                    (data[3] - data[1]) / 2.0,
-                    unit,
-                    value,
-                )
-            )
-    return result, referenced_sop_instance_uid
+        read = read_measurement_group(m)
+        if read is not None:
+            result.setdefault(read[1], []).append(read[0])
+    return result
+
+
+def get_measurements(dataset: Union[Dataset, str, Path]) -> Tuple[List[Measurement], str]:
+    """Retrieves measurements from this SR dataset.
+
+    Args:
+        dataset (Union[Dataset, str, Path]): The dataset or a path to it
+
+    Returns:
+        Tuple[List[Measurement], str]: A list of measurements and the ReferencedSOPInstanceUID.
+    """
+    by_image = get_measurements_by_image(dataset)
+    result = [
+        measurement for measurements in by_image.values() for measurement in measurements
+    ]
+    return result, next(iter(by_image), "")
 
 
 def read_annotations(
@@ -112,19 +148,25 @@ def read_annotations(
     """Read annotations in and verify that they reference the volume.
 
     Args:
-        volume (DicomVolume): The volume being annotated
+        volume (Union[DicomVolume, Sequence[Dataset]]): The volume being annotated, or its
+            slices
         sr_files (Sequence[Dataset | str | Path]): The annotation files.
 
     Returns: AnnotationSet
     """
     assert len(sr_files) > 0
+    get: Callable[[str], Optional[Dataset]]
+    if isinstance(volume, Sequence):
+        get = {str(s.SOPInstanceUID): s for s in volume}.get
+    else:
+        get = volume.get
     annotations = []
     for f in sr_files:
-        measurements, uid = get_measurements(f)
-        for s in volume:
-            if s.SOPInstanceUID == str(uid):
-                annotations.append(Annotations(measurements, s))
-                break
-        else:
-            raise Exception("ReferencedSOPInstanceUID for this SR does not exist in volume.")
+        for uid, measurements in get_measurements_by_image(f).items():
+            s = get(uid)
+            if s is None:
+                raise Exception(
+                    "ReferencedSOPInstanceUID for this SR does not exist in volume."
+                )
+            annotations.append(Annotations(measurements, s))
     return AnnotationSet(annotations)
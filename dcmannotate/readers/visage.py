@@ -92,12 +92,10 @@ def read_annotations(
     for sop_uid, measurements in measurement_sets.items():
         if len(measurements) == 0:
             continue
-        for s in volume:
-            if s.SOPInstanceUID == str(sop_uid):
-                annotations.append(Annotations(measurements, s))
-                break
-        else:
+        s = volume.get(str(sop_uid))
+        if s is None:
             raise Exception(
                 "ReferencedSOPInstanceUID for this measurement does not exist in volume."
             )
+        annotations.append(Annotations(measurements, s))
     return AnnotationSet(annotations)
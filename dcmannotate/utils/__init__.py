@@ -1,4 +1,6 @@
 from .annotation_format import annotation_format
+from .cache import LRUCache
+from .parallel import parallel_map
 from .point import Point, Vector
 
-__all__ = ["annotation_format", "Point", "Vector"]
+__all__ = ["annotation_format", "LRUCache", "parallel_map", "Point", "Vector"]
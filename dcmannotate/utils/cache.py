@@ -0,0 +1,51 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Hashable, Optional
+
+
+class LRUCache:
+    """A least-recently-used cache of numpy arrays, bounded by their total size in bytes."""
+
+    max_bytes: int
+    nbytes: int
+
+    def __init__(self, max_bytes: int):
+        if max_bytes < 0:
+            raise ValueError("max_bytes must not be negative.")
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.__items: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.__lock = Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.__lock:
+            if key not in self.__items:
+                return None
+            self.__items.move_to_end(key)
+            return self.__items[key]
+
+    def put(self, key: Hashable, array: Any) -> None:
+        """Store an array, evicting the least recently used ones until it fits.
+        Arrays larger than the whole budget are not stored."""
+        size = int(array.nbytes)
+        with self.__lock:
+            if key in self.__items:
+                self.nbytes -= self.__items.pop(key).nbytes
+            if size > self.max_bytes:
+                return
+            while self.__items and self.nbytes + size > self.max_bytes:
+                _, evicted = self.__items.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+            self.__items[key] = array
+            self.nbytes += size
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__items.clear()
+            self.nbytes = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.__items
+
+    def __len__(self) -> int:
+        return len(self.__items)
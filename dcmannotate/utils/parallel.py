@@ -0,0 +1,51 @@
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Iterable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+def parallel_map(
+    fn: Callable[..., T],
+    *iterables: Iterable[Any],
+    workers: Optional[int] = None,
+    processes: bool = False,
+) -> Iterator[T]:
+    """Apply fn to the items of iterables, yielding the results in input order.
+
+    Runs serially in the calling thread when workers is None or 1. Otherwise the calls are
+    spread over a pool of threads, or processes if processes=True. At most 2 * workers calls
+    are in flight at once, so results are not buffered far ahead of the consumer.
+
+    Args:
+        fn (Callable): The function to apply. Must be picklable if processes=True.
+        iterables (Iterable): Argument sequences, zipped together as with map().
+        workers (int, optional): Number of workers. Defaults to None.
+        processes (bool, optional): Use a process pool instead of threads. Defaults to False.
+
+    Yields:
+        The results of fn, in the same order as the inputs.
+    """
+    if workers is not None and workers < 1:
+        raise ValueError(f"workers must be a positive integer, not {workers}")
+    if not workers or workers == 1:
+        yield from map(fn, *iterables)
+        return
+
+    executor: Executor
+    if processes:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    pending: Deque["Future[T]"] = deque()
+    try:
+        for args in zip(*iterables):
+            pending.append(executor.submit(fn, *args))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
@@ -1,3 +1,3 @@
-from . import sc, sr, visage
+from . import overlay, png, sc, sr, visage
 
-__all__ = ["sc", "sr", "visage"]
+__all__ = ["overlay", "png", "sc", "sr", "visage"]
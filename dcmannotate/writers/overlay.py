@@ -0,0 +1,126 @@
+import copy
+from typing import Any, Iterator, TYPE_CHECKING
+
+import highdicom as hd
+import numpy as np
+from PIL import Image  # type: ignore
+
+from pydicom.dataset import Dataset
+from pydicom.multival import MultiValue
+from pydicom.sequence import Sequence
+
+if TYPE_CHECKING:  # avoid circular import
+    from dcmannotate.dicomvolume import DicomVolume  # pragma: no cover
+
+from dcmannotate.annotations import Annotations, AnnotationSet
+from dcmannotate.serialization import AnnotationEncoder
+from dcmannotate.writers.sc import draw_measurements
+
+# The SeriesNumber of the annotated copies, next to the 100 of the SC writer.
+SERIES_NUMBER = 101
+
+
+def generate(volume: "DicomVolume", annotation_set: AnnotationSet) -> Iterator[Dataset]:
+    """Generate a copy of each annotated slice, with its annotations drawn into a 1-bit
+    overlay plane instead of burned into the pixels. The original pixel data is carried
+    over as it is stored, without being decoded or encoded again. The copies form a new
+    derived series that references the slices in its SourceImageSequence, and are yielded
+    one at a time in z-order.
+
+    Args:
+        volume (DicomVolume): The volume.
+        annotation_set (AnnotationSet): The annotations to draw.
+
+    Returns:
+        Iterator[Dataset]: The annotated copies. Each has the z_index of its slice.
+    """
+    if not isinstance(annotation_set, AnnotationSet):
+        raise TypeError(
+            "Expected 'annotation_set' to be instance of AnnotationSet, "
+            f"not {type(annotation_set)}"
+        )
+    return _generate(volume, annotation_set)
+
+
+def _generate(volume: "DicomVolume", annotation_set: AnnotationSet) -> Iterator[Dataset]:
+    uid = hd.UID()
+    k = AnnotationEncoder()
+    for annotations in annotation_set:
+        slice = volume.get(annotations.reference.SOPInstanceUID)
+        if slice is None:
+            raise Exception("Annotations reference a slice that is not in this volume.")
+        ds = volume.full_dataset(slice)
+        if ds is slice:
+            ds = copy.deepcopy(slice)
+
+        ds.SOPInstanceUID = hd.UID()
+        if hasattr(ds, "file_meta"):
+            ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+        ds.SeriesInstanceUID = uid
+        mark_derived(ds, slice)
+        add_overlay(ds, rasterize(annotations, ds.Rows, ds.Columns), "dcmannotate")
+
+        block = ds.private_block(0x0091, "dcmannotate", create=True)
+        block.add_new(0, "UL", 1)
+        block.add_new(1, "LT", k.encode(annotations))
+        ds.z_index = slice.z_index
+        yield ds
+
+
+def mark_derived(ds: Dataset, source: Dataset) -> None:
+    """Mark a copy of a slice as a derived image in a series of its own: DERIVED\\SECONDARY
+    ImageType, its own SeriesNumber and SeriesDescription, and a SourceImageSequence that
+    references the slice."""
+    image_type = ds.get("ImageType")
+    ds.ImageType = ["DERIVED", "SECONDARY"] + (
+        list(image_type[2:]) if isinstance(image_type, MultiValue) else []
+    )
+    ds.SeriesNumber = SERIES_NUMBER
+    description = ds.get("SeriesDescription", "")
+    ds.SeriesDescription = f"{description} (annotated)" if description else "Annotated"
+
+    reference = Dataset()
+    reference.ReferencedSOPClassUID = source.SOPClassUID
+    reference.ReferencedSOPInstanceUID = source.SOPInstanceUID
+    ds.SourceImageSequence = Sequence([reference])
+
+
+def rasterize(annotations: Annotations, rows: int, columns: int) -> Any:
+    """Draw the ellipses, arrows and labels of a slice into a (rows, columns) bitmap of
+    zeros and ones, with the same drawing code as the SC writer."""
+    image = Image.new("1", (columns, rows), 0)
+    draw_measurements(image, annotations.ellipses, annotations.arrows, 1, 1)
+    return np.array(image, dtype=np.uint8)
+
+
+def add_overlay(ds: Dataset, bitmap: Any, description: str) -> int:
+    """Store a bitmap as a graphics overlay of the dataset, in the first free 60xx group.
+
+    Args:
+        ds (Dataset): The image to add the overlay to.
+        bitmap (Any): A (Rows, Columns) array, nonzero where the overlay is set.
+        description (str): The Overlay Description.
+
+    Returns:
+        int: The group of the overlay.
+    """
+    for group in range(0x6000, 0x6020, 2):
+        if (group, 0x3000) not in ds:
+            break
+    else:
+        raise ValueError("All 16 overlay planes of this dataset are in use.")
+
+    # Overlay bits are packed little endian: the first pixel is the lowest bit of byte 0.
+    data = np.packbits(bitmap.ravel() != 0, bitorder="little").tobytes()
+    if len(data) % 2:
+        data += b"\x00"
+
+    ds.add_new((group, 0x0010), "US", bitmap.shape[0])
+    ds.add_new((group, 0x0011), "US", bitmap.shape[1])
+    ds.add_new((group, 0x0022), "LO", description)
+    ds.add_new((group, 0x0040), "CS", "G")
+    ds.add_new((group, 0x0050), "SS", [1, 1])
+    ds.add_new((group, 0x0100), "US", 1)
+    ds.add_new((group, 0x0102), "US", 0)
+    ds.add_new((group, 0x3000), "OW", data)
+    return group
@@ -0,0 +1,78 @@
+import io
+from typing import Any, Iterator, List, Optional, Tuple, TYPE_CHECKING
+
+from PIL import Image  # type: ignore
+
+from dcmannotate.annotations import AnnotationSet
+from dcmannotate.measurements import Ellipse, PointMeasurement
+from dcmannotate.utils import parallel_map
+from dcmannotate.writers import sc
+
+if TYPE_CHECKING:  # avoid circular import
+    from dcmannotate.dicomvolume import DicomVolume  # pragma: no cover
+
+
+def generate(
+    volume: "DicomVolume",
+    annotation_set: AnnotationSet,
+    window: List[int] = [0, 255],
+    grayscale: bool = False,
+    only_annotated: bool = False,
+    workers: Optional[int] = None,
+    compress_level: int = 6,
+) -> Iterator[bytes]:
+    """Render the slices of the volume with their annotations drawn in, and encode each one
+    as PNG, without building DICOM datasets for them. The images look the same as the pixel
+    data of writers.sc.generate().
+
+    Args:
+        volume (DicomVolume): The volume.
+        annotation_set (AnnotationSet): The annotations to draw.
+        window (List[int], optional): The lower and upper bound of the display window.
+        grayscale (bool, optional): Encode slices without annotations as 8-bit grayscale
+            instead of RGB. Defaults to False.
+        only_annotated (bool, optional): Only render the slices that have annotations.
+            Defaults to False.
+        workers (int, optional): Render and encode the slices in a pool of this many
+            processes. Defaults to None.
+        compress_level (int, optional): The zlib compression level, from 0 to 9.
+            Defaults to 6.
+
+    Returns:
+        Iterator[bytes]: The encoded images, for the slices given by sc.slices_to_render().
+    """
+    if not isinstance(annotation_set, AnnotationSet):
+        raise TypeError(
+            "Expected 'annotation_set' to be instance of AnnotationSet, "
+            f"not {type(annotation_set)}"
+        )
+    if not 0 <= compress_level <= 9:
+        raise ValueError(f"compress_level must be between 0 and 9, not {compress_level}")
+
+    slices = sc.slices_to_render(volume, annotation_set, only_annotated)
+    return parallel_map(
+        encode_png,
+        *sc.render_arguments(volume, slices, annotation_set, window),
+        [grayscale] * len(slices),
+        [compress_level] * len(slices),
+        workers=workers,
+        processes=True,
+    )
+
+
+def encode_png(
+    pixel_array: Any,
+    slope: float,
+    intercept: float,
+    window: List[int],
+    drawings: Optional[Tuple[List[Ellipse], List[PointMeasurement]]],
+    grayscale: bool,
+    compress_level: int,
+) -> bytes:
+    """Render a slice with sc.render_pixels() and encode it as PNG."""
+    image = Image.fromarray(sc.render_pixels(pixel_array, slope, intercept, window, drawings))
+    if image.mode != "RGB" and not grayscale:
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    image.save(buffer, "png", compress_level=compress_level)
+    return buffer.getvalue()
@@ -1,21 +1,52 @@
+import copy
+import hashlib
+import io
+import json
 import math
-
-from typing import Any, List, Sequence, TYPE_CHECKING
+import struct
+import zlib
+
+from functools import lru_cache
+from pathlib import Path
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TYPE_CHECKING,
+    Union,
+)
 
 import highdicom as hd
 import numpy as np  # type: ignore
 from highdicom.sc.sop import SCImage
 from PIL import Image, ImageDraw, ImageFont  # type: ignore
 
-from pydicom.dataset import Dataset
+from pydicom.dataelem import DataElement
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.encaps import encapsulate
+from pydicom.encoders.base import RLELosslessEncoder
+from pydicom.filebase import DicomFileLike
+from pydicom.filewriter import write_dataset, write_file_meta_info
+from pydicom.multival import MultiValue
+from pydicom.sequence import Sequence as PydicomSequence
+from pydicom.uid import DeflatedExplicitVRLittleEndian, RLELossless
 
 if TYPE_CHECKING:  # avoid circular import
     from dcmannotate.dicomvolume import DicomVolume  # pragma: no cover
 
 from dcmannotate.annotations import Annotations, AnnotationSet
-from dcmannotate.measurements import PointMeasurement
+from dcmannotate.measurements import Ellipse, PointMeasurement
 from dcmannotate.serialization import AnnotationEncoder
-from dcmannotate.utils import Point, Vector
+from dcmannotate.utils import Point, Vector, parallel_map
+
+
+# The transfer syntaxes that SC images can be compressed with.
+COMPRESSION = {"rle": RLELossless, "deflate": DeflatedExplicitVRLittleEndian}
 
 
 def arrowedLine(
@@ -23,7 +54,7 @@ def arrowedLine(
     ptA: Point,
     ptB: PointMeasurement,
     width: int = 1,
-    color: str = "red",
+    color: Any = "red",
 ) -> None:
     """Draw line from ptA to ptB with arrowhead at ptB"""
     # Get drawing context
@@ -53,10 +84,14 @@ def arrowedLine(
 
 
 def sc_from_ref(reference_dataset: Dataset, pixel_array: Any) -> SCImage:
+    if pixel_array.ndim == 2:
+        photometric_interpretation = hd.PhotometricInterpretationValues.MONOCHROME2
+    else:
+        photometric_interpretation = hd.PhotometricInterpretationValues.RGB
     sc = hd.sc.SCImage.from_ref_dataset(
         ref_dataset=reference_dataset,
         pixel_array=pixel_array,
-        photometric_interpretation=hd.PhotometricInterpretationValues.RGB,
+        photometric_interpretation=photometric_interpretation,
         bits_allocated=8,
         coordinate_system=hd.CoordinateSystemNames.PATIENT,
         series_instance_uid=hd.UID(),
@@ -78,68 +113,427 @@ def generate(
     volume: "DicomVolume",
     annotation_set: AnnotationSet,
     window: List[int] = [0, 255],
-) -> Sequence[SCImage]:
+    grayscale: bool = False,
+    only_annotated: bool = False,
+    workers: Optional[int] = None,
+    compression: Optional[str] = None,
+    slices: Optional[Sequence[Dataset]] = None,
+    series_instance_uid: Optional[str] = None,
+) -> Iterator[Dataset]:
+    """Generate one SC image per slice of the volume, with the annotations drawn in. The
+    images are yielded one at a time as they are rendered, so that each can be written out
+    and freed before the next.
+
+    Args:
+        volume (DicomVolume): The volume.
+        annotation_set (AnnotationSet): The annotations to draw.
+        window (List[int], optional): The lower and upper bound of the display window.
+        grayscale (bool, optional): Emit slices without annotations as 8-bit MONOCHROME2
+            images, instead of RGB. Defaults to False.
+        only_annotated (bool, optional): Only generate images for the slices that have
+            annotations. They still share one series. Defaults to False.
+        workers (int, optional): Render the slices in a pool of this many processes. Only the
+            pixel data and annotations of each slice are sent to them. Defaults to None.
+        compression (str, optional): Compress the images with "rle" (RLE Lossless) or
+            "deflate" (Deflated Explicit VR Little Endian). The workers encode the RLE frames,
+            or deflate the pixel data for save() to write. Defaults to None, for uncompressed
+            images.
+        slices (Sequence[Dataset], optional): Only generate images for these slices of the
+            volume. Defaults to the slices given by slices_to_render().
+        series_instance_uid (str, optional): The SeriesInstanceUID of the images, eg to add
+            them to an existing series. Defaults to a new UID.
+
+    Returns:
+        Iterator[Dataset]: The SC images, in z-order. Each has the z_index of its slice, and
+        the content_hash() it was rendered from in the private block. Under deflate, each
+        also has its deflated pixel data, as deflated_pixel_data.
+    """
     if not isinstance(annotation_set, AnnotationSet):
         raise TypeError(
             f"Expected 'annotation_set' to be instance of AnnotationSet, not {type(annotation_set)}"
         )
+    if compression not in (None, *COMPRESSION):
+        raise ValueError(f"Unsupported compression {compression}")
+    if slices is None:
+        slices = slices_to_render(volume, annotation_set, only_annotated)
+    return _generate(
+        volume,
+        list(slices),
+        annotation_set,
+        window,
+        grayscale,
+        workers,
+        compression,
+        series_instance_uid or hd.UID(),
+    )
+
+
+def slices_to_render(
+    volume: "DicomVolume", annotation_set: AnnotationSet, only_annotated: bool = False
+) -> List[Dataset]:
+    """The slices of the volume that generate() makes an SC image for, in z-order."""
+    return [
+        slice
+        for slice in volume
+        if not only_annotated or slice.SOPInstanceUID in annotation_set
+    ]
+
+
+def render_arguments(
+    volume: "DicomVolume",
+    slices: List[Dataset],
+    annotation_set: AnnotationSet,
+    window: List[int],
+) -> List[Iterable[Any]]:
+    """The arguments of render_pixels() for the given slices, as one iterable per parameter.
+    Pixel data is only read as the first one is consumed."""
+    annotations = [annotation_set.get(slice.SOPInstanceUID) for slice in slices]
+    return [
+        (volume.pixel_array(slice) for slice in slices),
+        [float(getattr(slice, "RescaleSlope", 1)) for slice in slices],
+        [float(getattr(slice, "RescaleIntercept", 0)) for slice in slices],
+        [window] * len(slices),
+        [(a.ellipses, a.arrows) if a is not None else None for a in annotations],
+    ]
+
+
+def _generate(
+    volume: "DicomVolume",
+    slices: List[Dataset],
+    annotation_set: AnnotationSet,
+    window: List[int],
+    grayscale: bool,
+    workers: Optional[int],
+    compression: Optional[str],
+    uid: str,
+) -> Iterator[Dataset]:
+    annotations = [annotation_set.get(slice.SOPInstanceUID) for slice in slices]
+    rendered = parallel_map(
+        render_frame,
+        *render_arguments(volume, slices, annotation_set, window),
+        [grayscale] * len(slices),
+        [compression] * len(slices),
+        workers=workers,
+        processes=True,
+    )
+
+    k = AnnotationEncoder()
+    templates: Dict[Tuple[int, ...], Dataset] = {}
+    for slice, slice_annotations, (shape, pixel_data, deflated) in zip(
+        slices, annotations, rendered
+    ):
+        if shape not in templates:
+            templates[shape] = sc_template(slice, shape, uid, compression)
+        sc = sc_from_template(templates[shape], slice, pixel_data)
+        if deflated is not None:
+            sc.deflated_pixel_data = (pixel_data, deflated)
+
+        block = sc.private_block(0x0091, "dcmannotate")
+        encoded = k.encode(slice_annotations) if slice_annotations else "{}"
+        block.add_new(1, "LT", encoded)
+        block.add_new(2, "LO", content_hash(slice, encoded, window, grayscale, compression))
+        sc.z_index = slice.z_index
+        yield sc
+
+
+def content_hash(
+    slice: Dataset,
+    encoded_annotations: str,
+    window: List[int],
+    grayscale: bool = False,
+    compression: Optional[str] = None,
+) -> str:
+    """A hash of everything the SC image of a slice is rendered from, to tell whether an
+    existing image is still up to date.
+
+    Args:
+        slice (Dataset): The source slice.
+        encoded_annotations (str): The JSON of its annotations, or "{}" if it has none.
+        window (List[int]): The lower and upper bound of the display window.
+        grayscale (bool, optional): Whether slices without annotations are grayscale.
+        compression (str, optional): The compression of the image.
+
+    Returns:
+        str: The SHA-256 of these, as 64 hex digits.
+    """
+    key = json.dumps(
+        [str(slice.SOPInstanceUID), list(window), encoded_annotations, grayscale, compression]
+    )
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def render_frame(
+    pixel_array: Any,
+    slope: float,
+    intercept: float,
+    window: List[int],
+    drawings: Optional[Tuple[List[Ellipse], List[PointMeasurement]]],
+    grayscale: bool,
+    compression: Optional[str],
+) -> Tuple[Tuple[int, ...], bytes, Optional[bytes]]:
+    """Render a slice with render_pixels() and encode it as the Pixel Data of an SC image,
+    so that the encoding runs in the same worker process. Under deflate, the pixel data is
+    deflated there as well.
+
+    Returns:
+        Tuple[Tuple[int, ...], bytes, Optional[bytes]]: The shape of the image, its encoded
+        pixel data, and the deflate_pixels() of that, or None if not deflating.
+    """
+    pixels = render_pixels(pixel_array, slope, intercept, window, drawings)
+    if pixels.ndim == 2 and not grayscale:
+        pixels = _to_rgb(pixels)
+    pixel_data = encode_pixels(pixels, compression)
+    deflated = deflate_pixels(pixel_data) if compression == "deflate" else None
+    return pixels.shape, pixel_data, deflated
+
+
+def encode_pixels(pixels: Any, compression: Optional[str] = None) -> bytes:
+    """Encode an 8-bit image as Pixel Data. RLE Lossless frames are encapsulated, other
+    transfer syntaxes store the pixels as they are."""
+    if compression not in (None, *COMPRESSION):
+        raise ValueError(f"Unsupported compression {compression}")
+    if compression == "rle":
+        frame = RLELosslessEncoder.encode(
+            np.ascontiguousarray(pixels),
+            rows=pixels.shape[0],
+            columns=pixels.shape[1],
+            samples_per_pixel=1 if pixels.ndim == 2 else pixels.shape[2],
+            bits_allocated=8,
+            bits_stored=8,
+            pixel_representation=0,
+            photometric_interpretation="MONOCHROME2" if pixels.ndim == 2 else "RGB",
+            number_of_frames=1,
+            planar_configuration=0,
+        )
+        return encapsulate([frame])
+    pixel_data = np.ascontiguousarray(pixels).tobytes()
+    if len(pixel_data) % 2:
+        pixel_data += b"\x00"
+    return pixel_data
+
+
+def deflate_pixels(pixel_data: bytes) -> bytes:
+    """Deflate the value of the Pixel Data element, as the end of a Deflated Explicit VR
+    Little Endian data set. save() puts the deflated elements before it in front."""
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    return compressor.compress(pixel_data) + compressor.flush()
+
+
+def save(sc: Dataset, filename: Union[str, Path]) -> None:
+    """Write an SC image made by generate() to a file, like sc.save_as(filename).
+
+    Under deflate, only the elements before the Pixel Data are deflated here. They are
+    flushed to a byte boundary without ending the deflate stream, and the pixel data that
+    the worker already deflated is appended as the rest of the stream. Images without
+    deflated pixel data, or whose pixel data was changed since, are saved by pydicom.
+    """
+    pixel_data, deflated = getattr(sc, "deflated_pixel_data", (None, None))
+    if (
+        deflated is None
+        or sc.get("PixelData") is not pixel_data
+        or sc.file_meta.TransferSyntaxUID != DeflatedExplicitVRLittleEndian
+        or max(sc.keys()) != 0x7FE00010
+    ):
+        sc.save_as(filename)
+        return
+
+    encoded = io.BytesIO()
+    buffer = DicomFileLike(encoded)
+    buffer.is_little_endian = True
+    buffer.is_implicit_VR = False
+    write_dataset(buffer, sc[:0x7FE00010])
+    # The Pixel Data element header, in explicit VR: tag, VR, 2 reserved bytes, length.
+    # The template leaves the VR as "OB or OW", which pydicom resolves the same way.
+    vr = b"OW" if sc.BitsAllocated > 8 else b"OB"
+    buffer.write(struct.pack("<HH2s2xI", 0x7FE0, 0x0010, vr, len(pixel_data)))
+    compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+    header = compressor.compress(encoded.getvalue()) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    with open(filename, "wb") as fp:
+        fp.write(sc.preamble or b"\x00" * 128)
+        fp.write(b"DICM")
+        write_file_meta_info(DicomFileLike(fp), sc.file_meta, enforce_standard=False)
+        fp.write(header)
+        fp.write(deflated)
+        if (len(header) + len(deflated)) % 2:
+            fp.write(b"\x00")
+
+
+def sc_template(
+    reference_dataset: Dataset,
+    shape: Tuple[int, ...],
+    series_instance_uid: str,
+    compression: Optional[str] = None,
+) -> SCImage:
+    """An SC image without pixel data, holding the attributes that all the images of one
+    output series share: patient, study, series and equipment, and the pixel description
+    and transfer syntax of images of the given shape. Built once by highdicom, then copied
+    for each slice by sc_from_template()."""
+    template = sc_from_ref(reference_dataset, np.zeros(shape, dtype=np.uint8))
+    del template.PixelData
+    template.SeriesInstanceUID = series_instance_uid
+    template.private_block(0x0091, "dcmannotate", create=True).add_new(0, "UL", 1)
+    if compression is not None:
+        template.file_meta.TransferSyntaxUID = COMPRESSION[compression]
+        template.is_little_endian = True
+        template.is_implicit_VR = False
+        if compression == "rle" and template.SamplesPerPixel > 1:
+            template.PlanarConfiguration = 1
+    return template
+
+
+def sc_from_template(
+    template: Dataset, reference_dataset: Dataset, pixel_data: bytes
+) -> Dataset:
+    """Stamp out the SC image of one slice from a template made by sc_template(). Only its
+    pixel data, SOPInstanceUID, InstanceNumber, position and SourceImageSequence, which
+    references the slice, differ from the template.
+    pixel_data must be encoded for the template's transfer syntax, as by encode_pixels()."""
+    sc = _copy_dataset(template)
+    sc.file_meta = FileMetaDataset(_copy_dataset(template.file_meta))
+    sc.preamble = template.preamble
+    sc.is_little_endian = template.is_little_endian
+    sc.is_implicit_VR = template.is_implicit_VR
+
+    sc.SOPInstanceUID = hd.UID()
+    sc.file_meta.MediaStorageSOPInstanceUID = sc.SOPInstanceUID
+    sc.InstanceNumber = getattr(reference_dataset, "InstanceNumber", 0)
+    sc.ImageOrientationPatient = reference_dataset.ImageOrientationPatient
+    sc.SpacingBetweenSlices = reference_dataset.SpacingBetweenSlices
+    sc.ImagePositionPatient = reference_dataset.ImagePositionPatient
+    sc.FrameOfReferenceUID = reference_dataset.FrameOfReferenceUID
+    source = Dataset()
+    source.ReferencedSOPClassUID = reference_dataset.SOPClassUID
+    source.ReferencedSOPInstanceUID = reference_dataset.SOPInstanceUID
+    sc.SourceImageSequence = PydicomSequence([source])
+    sc.PixelData = pixel_data
+    if sc.file_meta.TransferSyntaxUID.is_encapsulated:
+        sc["PixelData"].is_undefined_length = True
+    return sc
+
 
-    scs = []
-    uid = hd.UID()
-    for slice in volume:
-        sc = None
-        pixels = None
-        annotations = None
-        if slice.SOPInstanceUID in annotation_set:
-            annotations = annotation_set[slice.SOPInstanceUID]
-            pixels = generate_pixels(annotations, window)
-        else:
-            pixels = window_image(slice, window)
-
-        sc = sc_from_ref(slice, pixels)
-
-        block = sc.private_block(0x0091, "dcmannotate", create=True)
-        k = AnnotationEncoder()
-        block.add_new(0, "UL", 1)
-        if annotations:
-            encoded = k.encode(annotations)
-            block.add_new(1, "LT", encoded)
-        else:
-            block.add_new(1, "LT", "{}")
-        sc.SeriesInstanceUID = uid
-        scs.append(sc)
-    return scs
-
-
-def window_image(reference_dataset: Dataset, window: List[int]) -> Any:
-    # Create an image for display by windowing the original image and drawing a
-    # bounding box over it using Pillow's ImageDraw module
+def _copy_dataset(ds: Dataset) -> Dataset:
+    # Much cheaper than a deepcopy: values are shared, apart from the mutable multi-valued
+    # elements and sequences, and are not converted again.
+    elements: Dict[Any, Any] = {}
+    for elem in ds:
+        value = elem.value
+        if isinstance(value, MultiValue):
+            elements[elem.tag] = DataElement(elem.tag, elem.VR, list(value))
+            continue
+        if isinstance(value, PydicomSequence):
+            value = copy.deepcopy(value)
+        elements[elem.tag] = DataElement(elem.tag, elem.VR, value, already_converted=True)
+    return Dataset(elements)
+
+
+@lru_cache(maxsize=64)
+def _window_lut(dtype: str, slope: float, intercept: float, lower: float, upper: float) -> Any:
+    """The lookup table mapping each stored value of a 8 or 16 bit integer dtype to its
+    windowed output. It is indexed by the values reinterpreted as unsigned, so that signed
+    inputs need no offset."""
+    bits = np.dtype(dtype).itemsize * 8
+    stored = np.arange(2**bits, dtype=np.uint32).astype(f"u{bits // 8}").view(dtype)
+    windowed = np.clip(stored * slope + intercept, lower, upper)
+    lut = ((windowed - lower) * 255 / (upper - lower)).astype(np.uint8)
+    lut.flags.writeable = False
+    return lut
+
+
+def window_image(
+    reference_dataset: Dataset,
+    window: List[int],
+    pixel_array: Optional[Any] = None,
+    rgb: bool = True,
+) -> Any:
+    """Window a slice to 8 bits. With rgb=True the result is a read-only (Rows, Columns, 3)
+    view broadcast from the grayscale image, otherwise the grayscale image itself."""
     slope = getattr(reference_dataset, "RescaleSlope", 1)
     intercept = getattr(reference_dataset, "RescaleIntercept", 0)
-    original_image = reference_dataset.pixel_array * slope + intercept
+    if pixel_array is None:
+        pixel_array = reference_dataset.pixel_array
+    windowed_image = _window(pixel_array, float(slope), float(intercept), window)
+    if not rgb:
+        return windowed_image
+    return _to_rgb(windowed_image)
 
-    # Window the image to a soft tissue window (center 40, width 400)
-    # and rescale to the range 0 to 255
-    lower = window[0]
-    upper = window[1]
-    windowed_image = np.clip(original_image, lower, upper)
-    windowed_image = (windowed_image - lower) * 255 / (upper - lower)
-    windowed_image = windowed_image.astype(np.uint8)
 
+def _to_rgb(windowed_image: Any) -> Any:
     # Create RGB channels
-    return np.tile(windowed_image[:, :, np.newaxis], [1, 1, 3])
+    return np.broadcast_to(windowed_image[:, :, np.newaxis], windowed_image.shape + (3,))
 
 
-def generate_pixels(annotations: Annotations, window: List[int]) -> Any:
-    reference_dataset, ellipses, arrows = (
-        annotations.reference,
-        annotations.ellipses,
-        annotations.arrows,
-    )
+def _window(pixel_array: Any, slope: float, intercept: float, window: List[int]) -> Any:
+    lower = window[0]
+    upper = window[1]
+
+    dtype = pixel_array.dtype
+    if dtype.kind in "iu" and dtype.itemsize <= 2 and dtype.isnative:
+        # Integer input: look the output up directly, in a single pass.
+        lut = _window_lut(dtype.str, slope, intercept, float(lower), float(upper))
+        return np.take(lut, pixel_array.view(f"u{dtype.itemsize}"))
+
+    original_image = pixel_array * slope + intercept
 
-    windowed_image = window_image(reference_dataset, window)
+    # Window the image to a soft tissue window (center 40, width 400)
+    # and rescale to the range 0 to 255
+    windowed_image = np.clip(original_image, lower, upper)
+    windowed_image = (windowed_image - lower) * 255 / (upper - lower)
+    return windowed_image.astype(np.uint8)
+
+
+def render_pixels(
+    pixel_array: Any,
+    slope: float,
+    intercept: float,
+    window: List[int],
+    drawings: Optional[Tuple[List[Ellipse], List[PointMeasurement]]],
+) -> Any:
+    """Window a slice and draw its annotations into it. Takes only plain values, so that it
+    can be sent to a worker process without the dataset.
+
+    Args:
+        pixel_array (Any): The stored pixel values of the slice.
+        slope (float): Its RescaleSlope.
+        intercept (float): Its RescaleIntercept.
+        window (List[int]): The lower and upper bound of the display window.
+        drawings (Optional[Tuple]): The ellipses and arrows to draw, or None if the slice
+            has no annotations.
+
+    Returns:
+        Any: The RGB image if there were drawings, otherwise the grayscale one.
+    """
+    windowed_image = _window(pixel_array, slope, intercept, window)
+    if drawings is None:
+        return windowed_image
+    return draw_annotations(windowed_image, *drawings)
+
+
+def generate_pixels(
+    annotations: Annotations, window: List[int], pixel_array: Optional[Any] = None
+) -> Any:
+    windowed_image = window_image(annotations.reference, window, pixel_array, rgb=False)
+    return draw_annotations(windowed_image, annotations.ellipses, annotations.arrows)
+
+
+def draw_annotations(
+    windowed_image: Any, ellipses: List[Ellipse], arrows: List[PointMeasurement]
+) -> Any:
     # Cast to a PIL image for easy drawing of boxes and text
-    pil_image = Image.fromarray(windowed_image)
+    pil_image = Image.fromarray(windowed_image).convert("RGB")
+    draw_measurements(pil_image, ellipses, arrows)
+    # Convert to numpy array
+    return np.array(pil_image)
+
+
+def draw_measurements(
+    pil_image: Image,
+    ellipses: List[Ellipse],
+    arrows: List[PointMeasurement],
+    line_color: Any = "red",
+    text_color: Any = "orange",
+) -> None:
+    """Draw ellipses and arrows with their labels onto a PIL image, in place. The colors are
+    given in the mode of the image."""
     draw_obj = ImageDraw.Draw(pil_image)
     draw_obj.fontmode = "1"
     font = ImageFont.load_default()
@@ -150,7 +544,7 @@ def generate_pixels(annotations: Annotations, window: List[int]) -> Any:
                 (ellipse.topleft.x, ellipse.topleft.y),
                 (ellipse.bottomright.x, ellipse.bottomright.y),
             ),
-            outline="red",
+            outline=line_color,
             fill=None,
             width=3,
         )
@@ -173,7 +567,9 @@ def generate_pixels(annotations: Annotations, window: List[int]) -> Any:
         if start_point.x + text_size[0] > pil_image.width:
             text_offset[0] = pil_image.width - (start_point.x + text_size[0])
 
-        arrowedLine(draw_obj, Point(start_point.x, start_point.y), arrow, width=2)
+        arrowedLine(
+            draw_obj, Point(start_point.x, start_point.y), arrow, width=2, color=line_color
+        )
         arrow_text_to_draw.append(
             (
                 (
@@ -215,21 +611,18 @@ def generate_pixels(annotations: Annotations, window: List[int]) -> Any:
                 int(ellipse.center.y - flip_y * ellipse.ry),
             ),
             width=2,
-            fill="red",
+            fill=line_color,
         )
         draw_obj.text(
             xy=text_loc,
             text=text,
-            fill="orange",
+            fill=text_color,
             font=font,
         )
     for r in arrow_text_to_draw:
         draw_obj.text(
             xy=r[0],
             text=r[1],
-            fill="orange",
+            fill=text_color,
             font=font,
         )
-
-        # Convert to numpy array
-    return np.array(pil_image)
@@ -1,14 +1,23 @@
+import os
 import shutil
+import tempfile
+from datetime import datetime
 from pathlib import Path
 from subprocess import PIPE, run
-from typing import List, Optional
+from typing import cast, List, Optional, Union
 
 import pydicom
 from jinja2 import Environment, FileSystemLoader, StrictUndefined
 
-from pydicom.uid import generate_uid
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.sr.coding import Code
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid, PYDICOM_IMPLEMENTATION_UID, UID
+from pydicom.valuerep import DS
 
 from dcmannotate.annotations import Annotations, AnnotationSet
+from dcmannotate.measurements import Ellipse, Measurement, PointMeasurement
+from dcmannotate.utils import parallel_map
 
 
 env = Environment(
@@ -19,6 +28,36 @@ env = Environment(
 env.globals["generate_uid"] = generate_uid
 template = env.get_template("base.xml")
 
+# The ways an SR can be encoded: built in-process, or rendered from templates/tid1500 and
+# converted with the DCMTK utility xml2dsr.
+ENGINES = ("native", "xml2dsr")
+
+ENHANCED_SR_STORAGE = UID("1.2.840.10008.5.1.4.1.1.88.22")
+MR_IMAGE_STORAGE = UID("1.2.840.10008.5.1.4.1.1.4")
+
+# The fixed values of templates/tid1500/base.xml, so that both engines write the same report.
+SERIES_NUMBER = 4702
+REPORT_DATE = "20211008"
+REPORT_TIME = "200402"
+
+IMAGING_MEASUREMENT_REPORT = Code("126000", "DCM", "Imaging Measurement Report")
+LANGUAGE = Code("121049", "DCM", "Language of Content Item and Descendants")
+ENGLISH = Code("eng", "RFC5646", "English")
+COUNTRY_OF_LANGUAGE = Code("121046", "DCM", "Country of Language")
+UNITED_STATES = Code("US", "ISO3166_1", "United States")
+PERSON_OBSERVER_NAME = Code("121008", "DCM", "Person Observer Name")
+PROCEDURE_REPORTED = Code("121058", "DCM", "Procedure reported")
+UNKNOWN_PROCEDURE = Code("1", "99dcmjs", "Unknown procedure")
+IMAGE_LIBRARY = Code("111028", "DCM", "Image Library")
+IMAGE_LIBRARY_GROUP = Code("126200", "DCM", "Image Library Group")
+IMAGING_MEASUREMENTS = Code("126010", "DCM", "Imaging Measurements")
+MEASUREMENT_GROUP = Code("125007", "DCM", "Measurement Group")
+TRACKING_IDENTIFIER = Code("112039", "DCM", "Tracking Identifier")
+TRACKING_UNIQUE_IDENTIFIER = Code("112040", "DCM", "Tracking Unique Identifier")
+FINDING = Code("121071", "DCM", "Finding")
+CENTER = Code("111010", "DCM", "Center")
+AREA = Code("G-D7FE", "SRT", "AREA")
+
 
 def generate_slice_xml(annotations: Annotations, description: str) -> str:
     reference_dataset, ellipses, arrows = (
@@ -39,10 +78,296 @@ def generate_xml(aset: AnnotationSet) -> List[str]:
     return [generate_slice_xml(a, "") for a in aset]
 
 
-def generate(
-    aset: "AnnotationSet", pattern: Optional[str] = None, *, force: Optional[bool] = False
-) -> List[Path]:
-    if not shutil.which("xml2dsr"):
+def code_item(code: Code) -> Dataset:
+    """A Code Sequence item for the given code."""
+    ds = Dataset()
+    ds.CodeValue = code.value
+    ds.CodingSchemeDesignator = code.scheme_designator
+    if code.scheme_version:
+        ds.CodingSchemeVersion = code.scheme_version
+    ds.CodeMeaning = code.meaning
+    return ds
+
+
+def content_item(relationship: Optional[str], value_type: str, concept: Code) -> Dataset:
+    """A content item of an SR content tree, without its value. The root item has no
+    relationship."""
+    ds = Dataset()
+    if relationship:
+        ds.RelationshipType = relationship
+    ds.ValueType = value_type
+    ds.ConceptNameCodeSequence = Sequence([code_item(concept)])
+    if value_type == "CONTAINER":
+        ds.ContinuityOfContent = "SEPARATE"
+    return ds
+
+
+def referenced_sop(reference: Dataset) -> Dataset:
+    """A Referenced SOP Sequence item for the given slice."""
+    ds = Dataset()
+    ds.ReferencedSOPClassUID = MR_IMAGE_STORAGE
+    ds.ReferencedSOPInstanceUID = reference.SOPInstanceUID
+    return ds
+
+
+def image_item(relationship: str, reference: Dataset) -> Dataset:
+    """An IMAGE content item referencing the given slice. Like the template, it has no
+    concept name."""
+    ds = Dataset()
+    ds.RelationshipType = relationship
+    ds.ValueType = "IMAGE"
+    ds.ReferencedSOPSequence = Sequence([referenced_sop(reference)])
+    return ds
+
+
+def measurement_group(measurement: Measurement, reference: Dataset) -> Dataset:
+    """The Measurement Group of one measurement, as in templates/tid1500/{arrow,ellipse}.xml.
+
+    Args:
+        measurement (Measurement): An Ellipse or PointMeasurement.
+        reference (Dataset): The slice it is on.
+
+    Returns:
+        Dataset: The CONTAINER content item.
+    """
+    group = content_item("CONTAINS", "CONTAINER", MEASUREMENT_GROUP)
+
+    tracking_id = content_item("HAS OBS CONTEXT", "TEXT", TRACKING_IDENTIFIER)
+    tool = "EllipticalRoi" if isinstance(measurement, Ellipse) else "ArrowAnnotate"
+    tracking_id.TextValue = f"cornerstoneTools@^4.0.0:{tool}"
+    tracking_uid = content_item("HAS OBS CONTEXT", "UIDREF", TRACKING_UNIQUE_IDENTIFIER)
+    tracking_uid.UID = generate_uid(prefix=None)
+    items = [tracking_id, tracking_uid]
+
+    if measurement.unit is None and measurement.value is not None:
+        finding = content_item("CONTAINS", "CODE", FINDING)
+        finding.ConceptCodeSequence = Sequence(
+            [code_item(Code("CORNERSTONEFREETEXT", "CST4", str(measurement.value)))]
+        )
+        items.append(finding)
+
+    scoord = Dataset()
+    scoord.RelationshipType = "INFERRED FROM"
+    scoord.ValueType = "SCOORD"
+    scoord.ContentSequence = Sequence([image_item("SELECTED FROM", reference)])
+    if isinstance(measurement, Ellipse):
+        num = content_item("CONTAINS", "NUM", AREA)
+        scoord.GraphicType = "ELLIPSE"
+        points = [measurement.top, measurement.bottom, measurement.left, measurement.right]
+        scoord.GraphicData = [float(c) for p in points for c in (p.x, p.y)]
+    else:
+        point = cast(PointMeasurement, measurement)
+        num = content_item("CONTAINS", "NUM", CENTER)
+        scoord.GraphicType = "POINT"
+        scoord.GraphicData = [float(point.x), float(point.y)]
+    num.ContentSequence = Sequence([scoord])
+
+    num.MeasuredValueSequence = Sequence()
+    if measurement.unit is not None:
+        value = Dataset()
+        value.NumericValue = DS(measurement.value, auto_format=True)
+        value.MeasurementUnitsCodeSequence = Sequence(
+            [code_item(Code(measurement.unit.value, "UCUM", measurement.unit.meaning, "1.4"))]
+        )
+        num.MeasuredValueSequence.append(value)
+    items.append(num)
+
+    group.ContentSequence = Sequence(items)
+    return group
+
+
+def make_dataset(
+    annotations: Union[Annotations, AnnotationSet], description: str = ""
+) -> Dataset:
+    """Build the TID1500 Measurement Report of one annotated slice in-process. The content
+    tree is the one of templates/tid1500, as converted by xml2dsr.
+
+    Given an AnnotationSet, builds one report for all of its slices instead: the image
+    library lists each of them, and each measurement group references its own slice.
+
+    Args:
+        annotations (Union[Annotations, AnnotationSet]): The annotations of the slice, or
+            of every slice.
+        description (str, optional): The SeriesDescription. Defaults to "".
+
+    Returns:
+        Dataset: The Enhanced SR, with file meta information, ready to be saved.
+    """
+    slices = list(annotations) if isinstance(annotations, AnnotationSet) else [annotations]
+    reference = slices[0].reference
+    dt = datetime.now()
+
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = ENHANCED_SR_STORAGE
+    file_meta.MediaStorageSOPInstanceUID = generate_uid(prefix=None)
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    file_meta.ImplementationClassUID = UID(PYDICOM_IMPLEMENTATION_UID)
+
+    ds = Dataset()
+    ds.file_meta = file_meta
+    ds.preamble = 128 * b"\0"
+    ds.is_implicit_VR = False
+    ds.is_little_endian = True
+
+    ds.SpecificCharacterSet = "ISO_IR 192"
+    ds.InstanceCreationDate = dt.strftime("%Y%m%d")
+    ds.InstanceCreationTime = dt.strftime("%H%M%S")
+    ds.SOPClassUID = ENHANCED_SR_STORAGE
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.StudyDate = ""
+    ds.SeriesDate = REPORT_DATE
+    ds.ContentDate = REPORT_DATE
+    ds.StudyTime = ""
+    ds.SeriesTime = REPORT_TIME
+    ds.ContentTime = REPORT_TIME
+    ds.AccessionNumber = ""
+    ds.Modality = "SR"
+    ds.Manufacturer = "Unspecified"
+    ds.ReferringPhysicianName = ""
+    ds.SeriesDescription = description
+    ds.ManufacturerModelName = "Unspecified"
+    ds.ReferencedPerformedProcedureStepSequence = Sequence()
+    ds.PatientName = ""
+    ds.PatientID = reference.PatientID
+    ds.PatientBirthDate = ""
+    ds.PatientSex = ""
+    ds.DeviceSerialNumber = "1"
+    ds.SoftwareVersions = "0"
+    ds.StudyInstanceUID = reference.StudyInstanceUID
+    ds.SeriesInstanceUID = generate_uid(prefix=None)
+    ds.StudyID = ""
+    ds.SeriesNumber = SERIES_NUMBER
+    ds.InstanceNumber = 1
+
+    coding_scheme = Dataset()
+    coding_scheme.CodingSchemeDesignator = "99dcmjs"
+    coding_scheme.CodingSchemeName = "Codes used for dcmjs"
+    coding_scheme.CodingSchemeVersion = "0"
+    coding_scheme.CodingSchemeResponsibleOrganization = "https://github.com/dcmjs-org/dcmjs"
+    ds.CodingSchemeIdentificationSequence = Sequence([coding_scheme])
+
+    # The slices of an AnnotationSet are all in the same series.
+    referenced_series = Dataset()
+    referenced_series.SeriesInstanceUID = reference.SeriesInstanceUID
+    referenced_series.ReferencedSOPSequence = Sequence(
+        [referenced_sop(a.reference) for a in slices]
+    )
+    evidence = Dataset()
+    evidence.StudyInstanceUID = reference.StudyInstanceUID
+    evidence.ReferencedSeriesSequence = Sequence([referenced_series])
+    ds.CurrentRequestedProcedureEvidenceSequence = Sequence([evidence])
+    ds.PerformedProcedureCodeSequence = Sequence()
+    ds.CompletionFlag = "COMPLETE"
+    ds.VerificationFlag = "UNVERIFIED"
+
+    # The content tree of the report.
+    ds.ValueType = "CONTAINER"
+    ds.ConceptNameCodeSequence = Sequence([code_item(IMAGING_MEASUREMENT_REPORT)])
+    ds.ContinuityOfContent = "SEPARATE"
+
+    language = content_item("HAS CONCEPT MOD", "CODE", LANGUAGE)
+    language.ConceptCodeSequence = Sequence([code_item(ENGLISH)])
+    country = content_item("HAS CONCEPT MOD", "CODE", COUNTRY_OF_LANGUAGE)
+    country.ConceptCodeSequence = Sequence([code_item(UNITED_STATES)])
+    language.ContentSequence = Sequence([country])
+
+    observer = content_item("HAS OBS CONTEXT", "PNAME", PERSON_OBSERVER_NAME)
+    observer.PersonName = "unknown^unknown"
+
+    procedure = content_item("HAS CONCEPT MOD", "CODE", PROCEDURE_REPORTED)
+    procedure.ConceptCodeSequence = Sequence([code_item(UNKNOWN_PROCEDURE)])
+
+    library = content_item("CONTAINS", "CONTAINER", IMAGE_LIBRARY)
+    library.ContentSequence = Sequence()
+    for a in slices:
+        library_group = content_item("CONTAINS", "CONTAINER", IMAGE_LIBRARY_GROUP)
+        library_group.ContentSequence = Sequence([image_item("CONTAINS", a.reference)])
+        library.ContentSequence.append(library_group)
+
+    measurements = content_item("CONTAINS", "CONTAINER", IMAGING_MEASUREMENTS)
+    measurements.ContentSequence = Sequence(
+        [measurement_group(m, a.reference) for a in slices for m in [*a.arrows, *a.ellipses]]
+    )
+
+    ds.ContentSequence = Sequence([language, observer, procedure, library, measurements])
+    return ds
+
+
+def convert_xml(xml: str) -> Dataset:
+    """Convert the XML of a report with xml2dsr, and fix_free_text() its findings. xml2dsr
+    can only write to a file, so it is read back from a temporary directory once; the fix up
+    runs on the dataset in memory.
+
+    Args:
+        xml (str): The report, as rendered from templates/tid1500.
+
+    Returns:
+        Dataset: The report.
+    """
+    with tempfile.TemporaryDirectory() as dir:
+        outfile = Path(dir) / "sr.dcm"
+        p = run(
+            ["xml2dsr", "-", str(outfile)],
+            stdout=PIPE,
+            stderr=PIPE,
+            input=xml,
+            encoding="utf-8",
+        )
+        if p.returncode != 0:
+            raise Exception(p.stderr)
+
+        d = pydicom.dcmread(outfile)
+
+    fix_free_text(d)
+    return d
+
+
+def fix_free_text(d: Dataset) -> None:
+    """xml2dsr stores the CORNERSTONEFREETEXT code of free text findings, which is too long
+    for a CodeValue, as a LongCodeValue. Move it to the CodeValue, where viewers look for
+    it. Only the Finding items of the measurement groups are visited, which is where the
+    templates put them.
+
+    Args:
+        d (Dataset): A report converted from templates/tid1500.
+    """
+    for container in d.ContentSequence:
+        if container.ConceptNameCodeSequence[0].CodeValue != IMAGING_MEASUREMENTS.value:
+            continue
+        for group in container.get("ContentSequence", []):
+            for item in group.ContentSequence:
+                if item.ValueType != "CODE":
+                    continue
+                code = item.ConceptCodeSequence[0]
+                if code.get("LongCodeValue") == "CORNERSTONEFREETEXT":
+                    code.add_new("CodeValue", "SH", "CORNERSTONEFREETEXT")
+                    del code.LongCodeValue
+
+
+def make_report(annotations: Union[Annotations, AnnotationSet], engine: str) -> Dataset:
+    """The report of one annotated slice, or the combined report of an AnnotationSet, made
+    with the given engine."""
+    if engine == "native":
+        return make_dataset(annotations)
+    return convert_xml(generate_slice_xml(cast(Annotations, annotations), ""))
+
+
+def write_report(
+    annotations: Union[Annotations, AnnotationSet], outfile: Path, engine: str
+) -> Path:
+    """Write the report of one annotated slice, or the combined report of an AnnotationSet,
+    with the given engine."""
+    make_report(annotations, engine).save_as(outfile, write_like_original=False)
+    return outfile
+
+
+def check(aset: AnnotationSet, engine: str, combined: bool = False) -> None:
+    """Raise if the reports cannot be made with this engine, before any of them is."""
+    if engine not in ENGINES:
+        raise ValueError(f"Unsupported SR engine {engine}")
+    if combined and engine != "native":
+        raise ValueError("Combined reports are only supported by the native SR engine.")
+    if engine == "xml2dsr" and not shutil.which("xml2dsr"):
         raise Exception(
             "DICOMSR output requires the utility 'xml2dsr' to be available in PATH. "
             "You may need to install DCMTK (https://dicom.offis.de/dcmtk.php.en) or fix your PATH."
@@ -53,46 +378,106 @@ def generate(
                 raise Exception(
                     f'{measurement} on slice {k.reference.z_index} has non-numeric value "{measurement.value}".'
                 )
-    xml_docs = generate_xml(aset)
+
+
+def make(
+    aset: AnnotationSet,
+    *,
+    engine: str = "native",
+    workers: Optional[int] = None,
+    combined: bool = False,
+) -> List[Dataset]:
+    """Make a TID1500 Measurement Report for each annotated slice, in memory.
+
+    Args:
+        aset (AnnotationSet): The annotations.
+        engine (str, optional): "native" to build the reports in-process, or "xml2dsr" to
+            convert them from templates/tid1500 with DCMTK. Defaults to "native".
+        workers (int, optional): Make this many reports at once, in a pool of threads.
+            Defaults to None.
+        combined (bool, optional): Make a single report for all of the slices instead, with
+            the native engine. Defaults to False.
+
+    Returns:
+        List[Dataset]: The reports, in the order of the annotation set.
+    """
+    check(aset, engine, combined)
+    reports: List[Union[Annotations, AnnotationSet]] = [aset] if combined else list(aset)
+    return list(parallel_map(make_report, reports, [engine] * len(reports), workers=workers))
+
+
+def generate(
+    aset: "AnnotationSet",
+    pattern: Optional[str] = None,
+    *,
+    force: Optional[bool] = False,
+    engine: str = "native",
+    workers: Optional[int] = None,
+    combined: bool = False,
+) -> List[Path]:
+    """Write a TID1500 Measurement Report for each annotated slice. The reports are written
+    to temporary files first, and only moved into place once all of them succeeded, so that
+    a failure leaves no partial output behind.
+
+    Args:
+        aset (AnnotationSet): The annotations.
+        pattern (str, optional): Pattern for output file names, eg "./out/slice_sr.*.dcm".
+            If None, each report is written next to its slice. Defaults to None.
+        force (bool, optional): Overwrite existing files. Defaults to False.
+        engine (str, optional): "native" to build the reports in-process, or "xml2dsr" to
+            convert them from templates/tid1500 with DCMTK. Defaults to "native".
+        workers (int, optional): Write this many reports at once, in a pool of threads. With
+            xml2dsr, each of them runs its own conversion process. Defaults to None.
+        combined (bool, optional): Write a single report for all of the slices instead, with
+            the native engine. The pattern is then the path of that file, without a
+            wildcard; if None, it is written next to the first slice as
+            <SeriesInstanceUID>_sr.dcm, apart from the per-slice reports. Defaults to False.
+
+    Returns:
+        List[Path]: The written files.
+    """
+    check(aset, engine, combined)
+    reports: List[Union[Annotations, AnnotationSet]] = [aset] if combined else list(aset)
     outfiles = []
 
-    for annotations in aset:
+    for report in reports:
+        first = next(iter(report)) if isinstance(report, AnnotationSet) else report
         if pattern is None:
-            frompath = annotations.reference.from_path
-            outfile = frompath.with_name(frompath.stem + "_sr.dcm")
+            frompath = first.reference.from_path
+            if combined:
+                # Not named after a slice, so that it never replaces that slice's own report.
+                outfile = frompath.with_name(f"{first.reference.SeriesInstanceUID}_sr.dcm")
+            else:
+                outfile = frompath.with_name(frompath.stem + "_sr.dcm")
+        elif combined:
+            if "*" in pattern:
+                raise Exception(
+                    "A combined report is a single file; pattern must not include '*'."
+                )
+            outfile = Path(pattern)
         else:
-            outfile = Path(pattern.replace("*", str(annotations.reference.z_index)))
+            outfile = Path(pattern.replace("*", str(first.reference.z_index)))
         if outfile.exists() and not force:
             raise FileExistsError(
                 f"{outfile} already exists and force=False, aborting with no files written."
             )
         outfiles.append(Path(outfile))
 
-    for outfile, xml in zip(outfiles, xml_docs):
-
-        p = run(
-            ["xml2dsr", "-", str(outfile)],
-            stdout=PIPE,
-            stderr=PIPE,
-            input=xml,
-            encoding="utf-8",
-        )
-        if p.returncode != 0:
-            raise Exception(p.stderr)
-
-        d = pydicom.dcmread(outfile)
-
-        for elem in d.iterall():
-            if elem.name == "Concept Code Sequence":
-                try:
-                    long_code_value = elem[0].LongCodeValue
-                except Exception:
-                    continue
-                if long_code_value == "CORNERSTONEFREETEXT":
-                    elem[0].add_new("CodeValue", "SH", "CORNERSTONEFREETEXT")
-                    del elem[0][0x00080119]
-                    # print(elem[0])
-
-        d.save_as(outfile)
+    temporary = [outfile.with_name(outfile.name + ".tmp") for outfile in outfiles]
+    try:
+        for _ in parallel_map(
+            write_report, reports, temporary, [engine] * len(outfiles), workers=workers
+        ):
+            pass
+    except BaseException:
+        # parallel_map has waited for the running reports, so none are written after this.
+        for tmp in temporary:
+            try:
+                tmp.unlink()
+            except FileNotFoundError:
+                pass
+        raise
+    for tmp, outfile in zip(temporary, outfiles):
+        os.replace(tmp, outfile)
 
     return outfiles
@@ -3,9 +3,12 @@ from dcmannotate import serialization, readers
 from dcmannotate.__main__ import read, parse_and_run
 from collections import namedtuple
 
+import pydicom
+
 from dcmannotate.dicomvolume import DicomVolume
+from dcmannotate.header_index import HeaderIndex
 
-ReadArgs = namedtuple("ReadArgs", ["annotation_files", "volume_files"])
+ReadArgs = namedtuple("ReadArgs", ["annotation_files", "volume_files", "workers", "index"])
 
 WriteArgs = namedtuple("WriteArgs", ["format", "annotations", "volume_files", "destination"])
 
@@ -30,7 +33,7 @@ def test_cli_read(input_volume_annotated: DicomVolume, tmpdir: Any) -> None:
             ["read", "-i", str(out_dir / "slice.*.dcm"), "-v", str(in_dir / "slice.*.dcm")]
         )
         assert isinstance(result_a, str)
-        result_b = read(ReadArgs(files, volume_files))
+        result_b = read(ReadArgs(files, volume_files, None, None))
 
         # print(json.dumps(json.loads(result_a), sort_keys=True, indent=4))
         # print(json.dumps(json.loads(result_b), sort_keys=True, indent=4))
@@ -75,3 +78,82 @@ def test_cli_write(input_volume_annotated: DicomVolume, tmpdir: Any) -> None:
             input_volume_annotated, result_files
         )
         assert input_volume_annotated.annotation_set == read_annotations
+
+
+def test_cli_index(input_volume: DicomVolume, tmpdir: Any) -> None:
+    in_dir = tmpdir.mkdir("data_in")
+    input_volume.save_as(str(in_dir / "slice.*.dcm"))
+
+    header_index = parse_and_run(["index", "-i", str(in_dir / "slice.*.dcm")])
+    assert header_index.path == in_dir / HeaderIndex.DEFAULT_NAME
+    assert len(header_index) == len(input_volume)
+    for f in input_volume.files:
+        assert f in header_index
+
+
+def test_cli_write_only_annotated(input_volume_annotated: DicomVolume, tmpdir: Any) -> None:
+    in_dir = tmpdir.mkdir("data_in")
+    input_volume_annotated.save_as(str(in_dir / "slice.*.dcm"))
+    serialized = serialization.AnnotationEncoder().encode(
+        input_volume_annotated.annotation_set
+    )
+
+    for format in ["sc", "png"]:
+        out_dir = tmpdir.mkdir(f"data_{format}")
+        result_files: Any = parse_and_run(
+            [
+                "write",
+                format,
+                "-i",
+                str(in_dir / "slice.*.dcm"),
+                "-o",
+                str(out_dir / f"slice.*.{format}"),
+                "-a",
+                serialized,
+                "--only-annotated",
+            ]
+        )
+        assert result_files == [
+            out_dir / f"slice.000.{format}",
+            out_dir / f"slice.001.{format}",
+        ]
+        assert sorted(out_dir.listdir()) == sorted(result_files)
+
+    scs = [pydicom.dcmread(str(f)) for f in sorted(tmpdir.join("data_sc").listdir())]
+    assert len(set(sc.SeriesInstanceUID for sc in scs)) == 1
+    assert all(
+        sc.FrameOfReferenceUID == input_volume_annotated[0].FrameOfReferenceUID for sc in scs
+    )
+    assert readers.sc.read_annotations(input_volume_annotated, scs) == (
+        input_volume_annotated.annotation_set
+    )
+
+
+def test_cli_combined_sr(input_volume_annotated: DicomVolume, tmpdir: Any) -> None:
+    in_dir = tmpdir.mkdir("data_in")
+    input_volume_annotated.save_as(str(in_dir / "slice.*.dcm"))
+    serialized = serialization.AnnotationEncoder().encode(
+        input_volume_annotated.annotation_set
+    )
+
+    result_files: Any = parse_and_run(
+        [
+            "write",
+            "sr",
+            "-i",
+            str(in_dir / "slice.*.dcm"),
+            "-o",
+            str(tmpdir / "report.dcm"),
+            "-a",
+            serialized,
+            "--combined",
+        ]
+    )
+    assert result_files == [tmpdir / "report.dcm"]
+
+    result = parse_and_run(["read", "-i", str(tmpdir / "report.dcm")])
+    assert isinstance(result, str)
+    assert (
+        serialization.read_annotations_from_json(input_volume_annotated, result)
+        == input_volume_annotated.annotation_set
+    )
@@ -1,5 +1,10 @@
+import copy
+import io
+import logging
+import os
+import shutil
 from pathlib import Path
-from typing import Any, List, cast
+from typing import Any, Iterator, List, cast
 
 from pydicom.dataset import Dataset
 from pydicom.sr.coding import Code
@@ -13,12 +18,16 @@ from dcmannotate import (
     PointMeasurement,
     Annotations,
     AnnotationSet,
+    HeaderIndex,
 )
+import numpy as np
+import pydicom
+from PIL import Image  # type: ignore
 import pytest
 
 from pydicom.sr.codedict import _CodesDict, codes
 
-from dcmannotate import readers
+from dcmannotate import readers, writers
 from dcmannotate import serialization
 from dcmannotate.serialization import AnnotationEncoder
 
@@ -29,6 +38,192 @@ def test_create_volume(input_series: List[Path]) -> None:
     assert len(volume) == 5
 
 
+def test_create_volume_parallel(input_series: List[Path]) -> None:
+    volume = DicomVolume(input_series)
+    threaded = DicomVolume(input_series, workers=4)
+    forked = DicomVolume(input_series, workers=2, processes=True)
+    for other in (threaded, forked):
+        assert [s.SOPInstanceUID for s in other] == [s.SOPInstanceUID for s in volume]
+        assert [s.from_path for s in other] == [s.from_path for s in volume]
+        assert (other[0].pixel_array == volume[0].pixel_array).all()
+
+
+def test_lazy_volume(input_series: List[Path], input_annotation_set: AnnotationSet) -> None:
+    volume = DicomVolume(input_series)
+    slice_bytes = volume[0].pixel_array.nbytes
+    lazy = DicomVolume(input_series, lazy=True, cache_bytes=2 * slice_bytes)
+    assert all("PixelData" not in s for s in lazy)
+    for k in range(len(lazy)):
+        assert (lazy.pixel_array(k) == volume.pixel_array(k)).all()
+    first = lazy.pixel_array(0)
+    assert lazy.pixel_array(0) is first
+    lazy.pixel_array(1), lazy.pixel_array(2)
+    assert lazy.pixel_array(0) is not first  # evicted
+
+    volume.annotate_with(input_annotation_set)
+    lazy.annotate_from_json(AnnotationEncoder().encode(input_annotation_set))
+    for a, b in zip(volume.make_sc(), lazy.make_sc()):
+        assert (a.pixel_array == b.pixel_array).all()
+
+
+def test_memmap_volume(input_series: List[Path]) -> None:
+    volume = DicomVolume(input_series)
+    mapped = DicomVolume(input_series, memmap=True)
+    assert all("PixelData" not in s for s in mapped)
+    for k in range(len(mapped)):
+        assert isinstance(mapped.pixel_array(k), np.memmap)
+        assert (mapped.pixel_array(k) == volume.pixel_array(k)).all()
+
+
+def test_slim_volume(input_series: List[Path], input_annotation_set: AnnotationSet) -> None:
+    volume = DicomVolume(input_series)
+    slim = DicomVolume(input_series, slim=True, memmap=True)
+    for k in range(len(slim)):
+        assert "ImageComments" not in slim[k] and "SliceLocation" not in slim[k]
+        assert slim[k].PatientName == volume[k].PatientName
+        assert (slim.pixel_array(k) == volume.pixel_array(k)).all()
+        full = slim.full_dataset(k)
+        assert full.ImageComments == volume[k].ImageComments
+        assert full.z_index == k
+
+    volume.annotate_with(input_annotation_set)
+    slim.annotate_from_json(AnnotationEncoder().encode(input_annotation_set))
+    for a, b in zip(volume.make_sc(), slim.make_sc()):
+        assert (a.pixel_array == b.pixel_array).all()
+    assert slim.make_visage().PatientName == volume.make_visage().PatientName
+
+
+def test_volume_array(input_series: List[Path]) -> None:
+    volume = DicomVolume(input_series)
+    lazy = DicomVolume(input_series, lazy=True)
+    stack = lazy.array()
+    assert stack is lazy.array()
+    assert stack.shape == (5, volume.Rows, volume.Columns)
+    assert stack.flags.c_contiguous and not stack.flags.writeable
+    for k in range(len(volume)):
+        assert (stack[k] == volume.pixel_array(k)).all()
+        assert np.shares_memory(lazy.pixel_array(k), stack)
+        assert np.shares_memory(lazy.pixel_array(lazy[k]), stack)
+
+
+def test_spacing_tolerance() -> None:
+    datasets = generate_test_series.generate_test_series(n=6)
+    for k, ds in enumerate(datasets):
+        ds.ImagePositionPatient = [0, 0, 7.5 * k + (1e-5 if k % 2 else 0)]
+    volume = DicomVolume(datasets[::-1])
+    assert [s.z_index for s in volume] == list(range(6))
+    assert [s.InstanceNumber for s in volume] == [str(k + 1) for k in range(6)]
+    assert abs(volume[0].z_spacing - 7.5) < 1e-3
+
+    with pytest.raises(ValueError, match="not evenly spaced"):
+        DicomVolume(datasets, spacing_tolerance=0)
+    with pytest.raises(ValueError, match="not evenly spaced"):
+        DicomVolume(datasets[:2] + datasets[3:])
+
+
+def test_sop_instance_uid_index(input_volume: DicomVolume) -> None:
+    for k, s in enumerate(input_volume):
+        assert s.SOPInstanceUID in input_volume
+        assert input_volume.get(s.SOPInstanceUID) is s
+        assert input_volume.index_of(s.SOPInstanceUID) == k
+    assert "1.2.3" not in input_volume
+    assert input_volume.get("1.2.3") is None
+    with pytest.raises(KeyError):
+        input_volume.index_of("1.2.3")
+
+
+def test_duplicate_slices(input_series: List[Path]) -> None:
+    paths = input_series + [input_series[1], Path(str(input_series[3]))]
+    with pytest.raises(ValueError, match="same file more than once") as e:
+        DicomVolume(paths)
+    assert str(input_series[1]) in str(e.value) and str(input_series[3]) in str(e.value)
+
+    datasets = generate_test_series.generate_test_series(n=4)
+    with pytest.raises(ValueError, match="Duplicate SOPInstanceUID") as e:
+        DicomVolume(datasets + [datasets[0], datasets[2]])
+    assert datasets[0].SOPInstanceUID in str(e.value)
+    assert datasets[2].SOPInstanceUID in str(e.value)
+
+
+def test_from_directory(tmpdir: Any, caplog: Any) -> None:
+    files = generate_test_series.generate_several_protocols(str(tmpdir / "study"))
+    (tmpdir / "study" / "notes.txt").write("not a dicom file")
+
+    groups = DicomVolume.scan(tmpdir / "study")
+    assert sorted(len(g) for g in groups) == [5, 5, 5, 5]
+    assert all("PatientName" not in ds for g in groups for ds in g)
+
+    volumes = DicomVolume.from_directory(tmpdir / "study")
+    assert len(volumes) == 4
+    assert len(set(v.SeriesInstanceUID for v in volumes)) == 4
+    for volume in volumes:
+        assert len(volume) == 5
+        assert [s.InstanceNumber for s in volume] == ["1", "2", "3", "4", "5"]
+        assert volume[0].PatientName == "Patient 1"
+        assert "PixelData" not in volume[0]
+        expected = DicomVolume([s.from_path for s in volume])
+        assert (volume.pixel_array(2) == expected.pixel_array(2)).all()
+    assert sorted(s.from_path for v in volumes for s in v) == sorted(files)
+
+    with pytest.raises(TypeError, match="lazzy"):
+        DicomVolume.from_directory(tmpdir / "study", lazzy=True)
+    single = pydicom.dcmread(files[0])
+    single.SeriesInstanceUID = pydicom.uid.generate_uid()
+    single.save_as(str(tmpdir / "study" / "single.dcm"))
+    with caplog.at_level(logging.INFO, logger="dcmannotate.dicomvolume"):
+        assert len(DicomVolume.from_directory(tmpdir / "study")) == 4
+    assert "Skipping 1 file(s)" in caplog.text
+
+
+def test_header_index(input_series: List[Path], tmpdir: Any) -> None:
+    index_path = Path(tmpdir) / "index.json"
+    volume = DicomVolume(input_series, index=index_path)
+    assert index_path.exists()
+
+    index = HeaderIndex(index_path)
+    assert len(index) == 5
+    stub = index.lookup(volume[2].from_path)
+    assert stub is not None and "PatientName" not in stub and not hasattr(stub, "z_index")
+
+    reopened = DicomVolume(input_series[::-1], index=index)
+    assert not index.changed
+    assert [s.SOPInstanceUID for s in reopened] == [s.SOPInstanceUID for s in volume]
+    assert reopened[0].PatientName == volume[0].PatientName
+    assert reopened[0].z_spacing == volume[0].z_spacing
+
+    os.utime(input_series[0], ns=(0, 0))
+    assert index.lookup(input_series[0]) is None
+    DicomVolume(input_series, index=index)
+    assert index.lookup(input_series[0]) is not None
+
+    index_path.write_text("{not json")
+    with pytest.warns(UserWarning, match="unreadable header index"):
+        reopened = DicomVolume(input_series, index=index_path)
+    assert len(reopened) == 5 and len(HeaderIndex(index_path)) == 5
+    assert len(DicomVolume(input_series, index=False)) == 5
+    assert [p.name for p in Path(tmpdir).iterdir()] == ["index.json"]
+
+
+def test_header_index_subsets(tmpdir: Any) -> None:
+    files = generate_test_series.generate_series(tmpdir / "series", 6)
+    in_order = [s.from_path for s in DicomVolume(files)]
+    index = HeaderIndex(Path(tmpdir) / "index.json")
+    DicomVolume(in_order[0:3], index=index)
+    DicomVolume(in_order[3:6], index=index)
+
+    # The slices are sorted within the volume they are opened in, not the one they were
+    # indexed in.
+    mixed = [in_order[3], in_order[1], in_order[2]]
+    reopened = DicomVolume(mixed, index=index)
+    assert [s.from_path for s in reopened] == [s.from_path for s in DicomVolume(mixed)]
+    with pytest.raises(ValueError, match="not evenly spaced"):
+        DicomVolume([in_order[0], in_order[4], in_order[5]], index=index)
+
+    with pytest.warns(UserWarning, match="Could not save the header index"):
+        volume = DicomVolume(in_order, index=Path(tmpdir) / "missing" / "index.json")
+    assert len(volume) == 6
+
+
 def test_create_annotation(input_volume: DicomVolume) -> None:
     assert input_volume.annotation_set is None
     a = Ellipse(Point(256, 256), 128, 128, "Millimeter", 1)
@@ -152,10 +347,166 @@ def test_roundtrip_sr(input_volume_annotated: DicomVolume) -> None:
     srs = input_volume_annotated.make_sr()
     read_annotations = readers.sr.read_annotations(input_volume_annotated, srs)
     assert input_volume_annotated.annotation_set == read_annotations
+    slices = list(input_volume_annotated)
+    assert readers.sr.read_annotations(slices, srs) == read_annotations
     input_volume_annotated.annotate_from(srs, True)
     assert input_volume_annotated.annotation_set == read_annotations
 
 
+def content_tree(item: Dataset) -> Any:
+    """The concepts, values and nesting of an SR content tree, without UIDs and dates."""
+    return (
+        item.get("RelationshipType"),
+        item.ValueType,
+        [
+            (c.CodeValue, c.CodingSchemeDesignator)
+            for c in item.get("ConceptNameCodeSequence", [])
+        ],
+        [(c.get("CodeValue"), c.CodeMeaning) for c in item.get("ConceptCodeSequence", [])],
+        item.get("TextValue"),
+        item.get("GraphicType"),
+        list(item.get("GraphicData", [])),
+        [float(v.NumericValue) for v in item.get("MeasuredValueSequence", [])],
+        [content_tree(k) for k in item.get("ContentSequence", [])],
+    )
+
+
+def test_write_sr_native(input_volume_annotated: DicomVolume, tmpdir: Any) -> None:
+    files = input_volume_annotated.write_sr(str(tmpdir / "slice.*.dcm"))
+    sr = pydicom.dcmread(files[0])
+    assert sr.file_meta.TransferSyntaxUID == pydicom.uid.ExplicitVRLittleEndian
+    assert (
+        sr.SOPClassUID
+        == sr.file_meta.MediaStorageSOPClassUID
+        == writers.sr.ENHANCED_SR_STORAGE
+    )
+    assert sr.SOPInstanceUID == sr.file_meta.MediaStorageSOPInstanceUID
+    assert sr.StudyInstanceUID == input_volume_annotated[0].StudyInstanceUID
+    evidence = sr.CurrentRequestedProcedureEvidenceSequence[0].ReferencedSeriesSequence[0]
+    assert evidence.SeriesInstanceUID == input_volume_annotated[0].SeriesInstanceUID
+    with pytest.raises(ValueError):
+        input_volume_annotated.write_sr(str(tmpdir / "other.*.dcm"), engine="dcmjs")
+
+
+def test_read_sr_other_graphic_types(input_volume_annotated: DicomVolume) -> None:
+    srs = input_volume_annotated.make_sr()
+    groups = srs[0].ContentSequence[4].ContentSequence
+    polyline = copy.deepcopy(groups[0])
+    for item in polyline.ContentSequence:
+        if item.ValueType == "NUM":
+            item.ContentSequence[0].GraphicType = "POLYLINE"
+    groups.append(polyline)
+
+    # Measurements that cannot be read are skipped.
+    read_annotations = readers.sr.read_annotations(input_volume_annotated, srs)
+    assert read_annotations == input_volume_annotated.annotation_set
+
+
+def test_make_sr_in_memory(input_volume_annotated: DicomVolume, monkeypatch: Any) -> None:
+    def no_files(*args: Any, **kwargs: Any) -> None:
+        raise AssertionError("make_sr touched the filesystem")
+
+    with monkeypatch.context() as m:
+        m.setattr(Dataset, "save_as", no_files)
+        m.setattr(pydicom, "dcmread", no_files)
+        srs = input_volume_annotated.make_sr(workers=2)
+
+    buffer = io.BytesIO()
+    pydicom.dcmwrite(buffer, srs[0], write_like_original=False)
+    buffer.seek(0)
+    sr = pydicom.dcmread(buffer)
+    assert sr.SOPInstanceUID == srs[0].SOPInstanceUID
+    first = list(cast(AnnotationSet, input_volume_annotated.annotation_set))[0]
+    assert readers.sr.read_annotations(input_volume_annotated, [sr]) == AnnotationSet([first])
+
+
+def test_write_sr_workers(
+    input_volume_annotated: DicomVolume, tmpdir: Any, monkeypatch: Any
+) -> None:
+    files = input_volume_annotated.write_sr(str(tmpdir / "slice.*.dcm"), workers=2)
+    assert [f.name for f in files] == ["slice.0.dcm", "slice.1.dcm"]
+    srs = [pydicom.dcmread(f) for f in files]
+    assert readers.sr.read_annotations(input_volume_annotated, srs) == (
+        input_volume_annotated.annotation_set
+    )
+
+    make_dataset = writers.sr.make_dataset
+
+    def fail_on_slice_1(annotations: Annotations, description: str = "") -> Dataset:
+        if annotations.reference.z_index == 1:
+            raise RuntimeError("conversion failed")
+        return make_dataset(annotations, description)
+
+    monkeypatch.setattr(writers.sr, "make_dataset", fail_on_slice_1)
+    with pytest.raises(RuntimeError):
+        input_volume_annotated.write_sr(str(tmpdir / "failed.*.dcm"), workers=2)
+    assert sorted(os.listdir(tmpdir)) == ["slice.0.dcm", "slice.1.dcm"]
+
+
+def test_fix_free_text(input_volume_annotated: DicomVolume) -> None:
+    sr = input_volume_annotated.make_sr()[0]
+    expected = content_tree(sr)
+    # Store the findings the way xml2dsr does.
+    findings = [
+        item.ConceptCodeSequence[0]
+        for group in sr.ContentSequence[4].ContentSequence
+        for item in group.ContentSequence
+        if item.ValueType == "CODE"
+    ]
+    assert len(findings) == 2
+    for code in findings:
+        code.LongCodeValue = code.CodeValue
+        del code.CodeValue
+    assert content_tree(sr) != expected
+
+    writers.sr.fix_free_text(sr)
+    assert content_tree(sr) == expected
+    assert all("LongCodeValue" not in code for code in findings)
+
+
+def test_combined_sr(input_volume_annotated: DicomVolume, tmpdir: Any) -> None:
+    annotation_set = cast(AnnotationSet, input_volume_annotated.annotation_set)
+    srs = input_volume_annotated.make_sr(combined=True)
+    assert len(srs) == 1
+    sr = srs[0]
+
+    library, measurements = sr.ContentSequence[3], sr.ContentSequence[4]
+    assert [
+        group.ContentSequence[0].ReferencedSOPSequence[0].ReferencedSOPInstanceUID
+        for group in library.ContentSequence
+    ] == [a.SOPInstanceUID for a in annotation_set]
+    assert len(measurements.ContentSequence) == sum(len(list(a)) for a in annotation_set)
+    evidence = sr.CurrentRequestedProcedureEvidenceSequence[0].ReferencedSeriesSequence[0]
+    assert len(evidence.ReferencedSOPSequence) == len(list(annotation_set))
+
+    assert readers.sr.read_annotations(input_volume_annotated, srs) == annotation_set
+    files = input_volume_annotated.write_sr(str(tmpdir / "report.dcm"), combined=True)
+    assert files == [tmpdir / "report.dcm"]
+    input_volume_annotated.annotate_from(files, force=True)
+    assert input_volume_annotated.annotation_set == annotation_set
+
+    with pytest.raises(Exception):
+        input_volume_annotated.write_sr(str(tmpdir / "report.*.dcm"), combined=True)
+    with pytest.raises(ValueError):
+        input_volume_annotated.make_sr(combined=True, engine="xml2dsr")
+
+    # Without a pattern, the combined report and the per-slice reports do not collide.
+    copied = DicomVolume(input_volume_annotated.save_as(str(tmpdir / "slice.*.dcm")))
+    copied.annotate_from_json(AnnotationEncoder().encode(annotation_set))
+    per_slice = copied.write_sr()
+    combined = copied.write_sr(combined=True)
+    assert combined == [tmpdir / f"{copied[0].SeriesInstanceUID}_sr.dcm"]
+    assert not set(combined) & set(per_slice)
+
+
+@pytest.mark.skipif(not shutil.which("xml2dsr"), reason="requires DCMTK")
+def test_sr_engines(input_volume_annotated: DicomVolume) -> None:
+    native = input_volume_annotated.make_sr()
+    converted = input_volume_annotated.make_sr(engine="xml2dsr")
+    for a, b in zip(native, converted):
+        assert content_tree(a) == content_tree(b)
+
+
 def test_roundtrip_sc(input_volume_annotated: DicomVolume) -> None:
     scs = input_volume_annotated.make_sc()
     read_annotations = readers.sc.read_annotations(input_volume_annotated, scs)
@@ -164,6 +515,235 @@ def test_roundtrip_sc(input_volume_annotated: DicomVolume) -> None:
     assert input_volume_annotated.annotation_set == read_annotations
 
 
+def test_grayscale_sc(input_volume_annotated: DicomVolume, tmpdir: Any) -> None:
+    rgb = input_volume_annotated.make_sc()
+    gray = input_volume_annotated.make_sc(grayscale=True)
+    annotated = cast(AnnotationSet, input_volume_annotated.annotation_set)
+    for ref, a, b in zip(input_volume_annotated, rgb, gray):
+        if ref.SOPInstanceUID in annotated:
+            assert b.PhotometricInterpretation == "RGB"
+            assert (a.pixel_array == b.pixel_array).all()
+        else:
+            assert b.PhotometricInterpretation == "MONOCHROME2" and b.SamplesPerPixel == 1
+            assert len(b.PixelData) * 3 == len(a.PixelData)
+            assert (a.pixel_array[:, :, 0] == b.pixel_array).all()
+    assert readers.sc.read_annotations(input_volume_annotated, gray) == annotated
+
+    files = input_volume_annotated.write_png(str(tmpdir / "slice.*.png"), grayscale=True)
+    assert len(files) == len(input_volume_annotated)
+
+
+def test_parallel_sc(input_volume_annotated: DicomVolume, tmpdir: Any) -> None:
+    serial = input_volume_annotated.make_sc(grayscale=True)
+    parallel = input_volume_annotated.make_sc(grayscale=True, workers=3)
+    assert len(serial) == len(parallel)
+    for a, b in zip(serial, parallel):
+        assert a.PhotometricInterpretation == b.PhotometricInterpretation
+        assert a.ImagePositionPatient == b.ImagePositionPatient
+        assert (a.pixel_array == b.pixel_array).all()
+    annotation_set = input_volume_annotated.annotation_set
+    assert readers.sc.read_annotations(input_volume_annotated, parallel) == annotation_set
+
+
+def test_write_sc_streaming(
+    input_volume_annotated: DicomVolume, tmpdir: Any, monkeypatch: Any
+) -> None:
+    annotation_set = cast(AnnotationSet, input_volume_annotated.annotation_set)
+    scs = writers.sc.generate(input_volume_annotated, annotation_set)
+    assert not isinstance(scs, list)
+    assert next(scs).z_index == 0
+
+    pattern = str(tmpdir / "slice.*.dcm")
+    files = input_volume_annotated.write_png(str(tmpdir / "slice.*.png"))
+    files += input_volume_annotated.write_sc(pattern)
+    contents = [f.read_bytes() for f in files]
+
+    generate = writers.sc.generate
+
+    def fail_on_slice_2(*args: Any, **kwargs: Any) -> Iterator[Dataset]:
+        for sc in generate(*args, **kwargs):
+            if sc.z_index == 2:
+                raise RuntimeError("rendering failed")
+            yield sc
+
+    # Overwriting fails halfway through, and leaves the earlier output as it was.
+    monkeypatch.setattr(writers.sc, "generate", fail_on_slice_2)
+    with pytest.raises(RuntimeError):
+        input_volume_annotated.write_sc(pattern, force=True, grayscale=True)
+    assert sorted(tmpdir.listdir()) == sorted(tmpdir / f.name for f in files)
+    assert [f.read_bytes() for f in files] == contents
+
+
+def test_write_png(input_volume_annotated: DicomVolume, tmpdir: Any) -> None:
+    scs = input_volume_annotated.make_sc()
+    files = input_volume_annotated.write_png(str(tmpdir / "slice.*.png"), workers=2)
+    stored = input_volume_annotated.write_png(
+        str(tmpdir / "stored.*.png"), compress_level=0, only_annotated=True
+    )
+    assert len(files) == len(scs) and len(stored) == 2
+    for sc, f in zip(scs, files):
+        with Image.open(f) as im:
+            assert im.mode == "RGB"
+            assert (np.asarray(im) == sc.pixel_array).all()
+    for f, s in zip(files, stored):
+        assert f.stat().st_size < s.stat().st_size
+
+
+def test_sc_template(input_volume: DicomVolume) -> None:
+    pixels = np.zeros((input_volume.Rows, input_volume.Columns, 3), dtype=np.uint8)
+    template = writers.sc.sc_template(input_volume[0], pixels.shape, "1.2.3")
+    assert "PixelData" not in template
+    for k, slice in enumerate(input_volume):
+        pixels[:] = k
+        sc = writers.sc.sc_from_template(template, slice, writers.sc.encode_pixels(pixels))
+        expected = writers.sc.sc_from_ref(slice, pixels)
+        for elem in expected:
+            if (
+                elem.keyword in ("SOPInstanceUID", "SeriesInstanceUID")
+                or "Time" in elem.keyword
+            ):
+                continue
+            assert sc[elem.tag].value == elem.value
+        assert sc.SeriesInstanceUID == "1.2.3"
+        assert sc.SOPInstanceUID == sc.file_meta.MediaStorageSOPInstanceUID
+        assert sc.SOPInstanceUID != template.SOPInstanceUID
+        sc.ImagePositionPatient[2] = -1
+    assert template.ImagePositionPatient == input_volume[0].ImagePositionPatient
+
+
+@pytest.mark.parametrize("compression", ["rle", "deflate"])
+def test_compressed_sc(
+    input_volume_annotated: DicomVolume, tmpdir: Any, compression: str
+) -> None:
+    uncompressed = input_volume_annotated.write_sc(str(tmpdir / "plain.*.dcm"), grayscale=True)
+    files = input_volume_annotated.write_sc(
+        str(tmpdir / "slice.*.dcm"), grayscale=True, compression=compression, workers=2
+    )
+    for plain, f in zip(uncompressed, files):
+        sc = pydicom.dcmread(f)
+        assert sc.file_meta.TransferSyntaxUID == writers.sc.COMPRESSION[compression]
+        assert f.stat().st_size < plain.stat().st_size
+        assert (sc.pixel_array == pydicom.dcmread(plain).pixel_array).all()
+    scs = [pydicom.dcmread(f) for f in files]
+    assert readers.sc.read_annotations(input_volume_annotated, scs) == (
+        input_volume_annotated.annotation_set
+    )
+
+
+def test_deflate_in_workers(
+    input_volume_annotated: DicomVolume, tmpdir: Any, monkeypatch: Any
+) -> None:
+    annotation_set = cast(AnnotationSet, input_volume_annotated.annotation_set)
+    save_as = Dataset.save_as
+
+    def not_on_main_thread(*args: Any, **kwargs: Any) -> None:
+        raise AssertionError("the pixel data was deflated again")
+
+    for sc in writers.sc.generate(
+        input_volume_annotated, annotation_set, compression="deflate", workers=2
+    ):
+        assert sc.deflated_pixel_data[0] is sc.PixelData
+        with monkeypatch.context() as m:
+            m.setattr(Dataset, "save_as", not_on_main_thread)
+            writers.sc.save(sc, tmpdir / "deflated.dcm")
+        save_as(sc, tmpdir / "pydicom.dcm")
+        deflated = pydicom.dcmread(tmpdir / "deflated.dcm")
+        assert deflated == pydicom.dcmread(tmpdir / "pydicom.dcm")
+        assert (deflated.pixel_array == sc.pixel_array).all()
+
+        # Changed pixel data is deflated again when saving.
+        sc.PixelData = bytes(len(sc.PixelData))
+        writers.sc.save(sc, tmpdir / "changed.dcm")
+        assert not pydicom.dcmread(tmpdir / "changed.dcm").pixel_array.any()
+
+
+def test_write_overlay(input_volume_annotated: DicomVolume, tmpdir: Any) -> None:
+    annotation_set = cast(AnnotationSet, input_volume_annotated.annotation_set)
+    files = input_volume_annotated.write_overlay(str(tmpdir / "slice.*.dcm"))
+    assert files == [tmpdir / "slice.000.dcm", tmpdir / "slice.001.dcm"]
+
+    datasets = [pydicom.dcmread(f) for f in files]
+    for ds, annotations in zip(datasets, annotation_set):
+        source = input_volume_annotated[annotations.reference.z_index]
+        assert ds.PixelData == source.PixelData
+        assert ds.SOPInstanceUID != source.SOPInstanceUID
+        assert list(ds.ImageType[:2]) == ["DERIVED", "SECONDARY"]
+        assert ds.SeriesNumber == writers.overlay.SERIES_NUMBER
+        assert ds.SeriesDescription != source.get("SeriesDescription")
+        assert ds.SourceImageSequence[0].ReferencedSOPInstanceUID == source.SOPInstanceUID
+        overlay = ds.overlay_array(0x6000)
+        assert overlay.any()
+        assert (overlay == writers.overlay.rasterize(annotations, ds.Rows, ds.Columns)).all()
+        assert len(ds[0x60003000].value) * 24 == source.Rows * source.Columns * 3
+    assert datasets[0].SeriesInstanceUID == datasets[1].SeriesInstanceUID
+    assert readers.sc.read_annotations(input_volume_annotated, datasets) == annotation_set
+
+
+def test_write_sc_incremental(input_volume_annotated: DicomVolume, tmpdir: Any) -> None:
+    pattern = str(tmpdir / "slice.*.dcm")
+    files = input_volume_annotated.write_sc(pattern, incremental=True)
+    assert len(files) == len(input_volume_annotated)
+    series = pydicom.dcmread(files[0]).SeriesInstanceUID
+    assert input_volume_annotated.write_sc(pattern, incremental=True) == []
+
+    annotation_set = cast(AnnotationSet, input_volume_annotated.annotation_set)
+    edited = Annotations(
+        [Ellipse(Point(128, 128), 64, 64, "Millimeter", 2)], input_volume_annotated[1]
+    )
+    input_volume_annotated.annotate_with(
+        AnnotationSet([a for a in annotation_set if a.reference.z_index != 1] + [edited]),
+        force=True,
+    )
+    assert input_volume_annotated.write_sc(pattern, incremental=True) == [files[1]]
+    scs = [pydicom.dcmread(f) for f in files]
+    assert all(sc.SeriesInstanceUID == series for sc in scs)
+    assert readers.sc.read_annotations(input_volume_annotated, scs) == (
+        input_volume_annotated.annotation_set
+    )
+    assert readers.sc.get_content_hash(files[1]) != readers.sc.get_content_hash(files[0])
+
+    assert input_volume_annotated.write_sc(pattern, incremental=True, grayscale=True) == files
+    files[0].write_bytes(b"not an SC")
+    with pytest.raises(FileExistsError):
+        input_volume_annotated.write_sc(pattern, incremental=True)
+    assert input_volume_annotated.write_sc(pattern, incremental=True, force=True) == files
+
+
+def test_write_sc_incremental_other_volume(
+    input_volume_annotated: DicomVolume, tmpdir: Any
+) -> None:
+    pattern = str(tmpdir / "slice.*.dcm")
+    files = input_volume_annotated.write_sc(pattern)
+    series = pydicom.dcmread(files[0]).SeriesInstanceUID
+
+    other = DicomVolume(generate_test_series.generate_series(tmpdir / "other", 5))
+    other.annotate_with(AnnotationSet([Annotations([], other[0])]))
+    with pytest.raises(FileExistsError, match="for this volume"):
+        other.write_sc(pattern, incremental=True)
+    assert all(pydicom.dcmread(f).SeriesInstanceUID == series for f in files)
+
+    assert other.write_sc(pattern, incremental=True, force=True) == files
+    scs = [pydicom.dcmread(f) for f in files]
+    assert len({sc.SeriesInstanceUID for sc in scs} | {series}) == 2
+    assert [sc.SourceImageSequence[0].ReferencedSOPInstanceUID for sc in scs] == [
+        slice.SOPInstanceUID for slice in other
+    ]
+
+
+@pytest.mark.parametrize("dtype", ["u1", "i1", "u2", "i2"])
+def test_window_lut(dtype: str) -> None:
+    info = np.iinfo(dtype)
+    pixels = np.linspace(info.min, info.max, 64 * 64).astype(dtype).reshape(64, 64)
+    ds = Dataset()
+    ds.RescaleSlope = 2.5
+    ds.RescaleIntercept = -100
+    for window in ([0, 255], [-160, 240]):
+        windowed = writers.sc.window_image(ds, window, pixels)
+        expected = writers.sc.window_image(ds, window, pixels.astype(np.float64))
+        assert windowed.shape == (64, 64, 3) and windowed.dtype == np.uint8
+        assert (windowed == expected).all()
+
+
 def test_from_json(input_volume: DicomVolume, input_annotation_set: AnnotationSet) -> None:
     k = AnnotationEncoder()
     json = k.encode(input_annotation_set)